@@ -0,0 +1,112 @@
+"""
+Chunking throughput and retrieval recall: the sentence-aware, token-budgeted
+chunker (utils/text_utils.iter_chunks) vs the previous fixed ~800-word
+windows.
+
+    python benchmarks/bench_chunking.py --docs 200 --facts 300 --k 5
+
+The synthetic corpus hides "fact" sentences (a project's access code) at
+random places in filler text. Each chunker's chunks are embedded, and for
+every fact the matching question is run as a query. A fact counts as
+recalled when one of the top-k chunks contains the whole fact sentence
+within the part the model actually embeds (the first MAX_SEQ_LENGTH
+tokens). The script also reports chunks/s, MB/s and how many chunks
+exceed the model's window.
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.embeddings import MAX_SEQ_LENGTH, _encode, get_tokenizer
+from utils.text_utils import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, iter_chunks
+
+WORDS = ('document invoice payment contract clause section report revenue quarter policy '
+         'employee benefit insurance claim deadline meeting schedule project budget summary '
+         'customer order delivery warranty refund account balance statement tax agreement').split()
+NAMES = ('apollo borealis cascade dynamo ember falcon glacier harbor ion juniper kestrel lumen '
+         'meridian nebula orchid pioneer quartz raven sierra tundra umbra vertex willow xenon yonder zephyr').split()
+
+
+def synthetic_corpus(n_docs, n_facts, pages_per_doc=4, sentences_per_page=60, seed=0):
+    """Pages of filler sentences with fact sentences planted in them, plus the fact list."""
+    rng = random.Random(seed)
+    pages = [
+        [' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 22))).capitalize() + '.'
+         for _ in range(sentences_per_page)]
+        for _ in range(n_docs * pages_per_doc)
+    ]
+    facts = []
+    for i in range(n_facts):
+        name = f"{NAMES[i % len(NAMES)]} {i // len(NAMES)}"
+        code = rng.randint(1000, 9999)
+        fact = f"The access code for project {name} is {code}."
+        page = rng.randrange(len(pages))
+        pages[page].insert(rng.randrange(len(pages[page]) + 1), fact)
+        facts.append((fact, f"What is the access code for project {name}?"))
+    records = [{ "pageNumber": i + 1, "text": ' '.join(sentences) } for i, sentences in enumerate(pages)]
+    return records, facts
+
+
+def word_windows(pages, min_tokens=500, max_tokens=700):
+    """The previous chunker: fixed word windows assuming 0.75 words per token, no overlap."""
+    target_words = int((min_tokens + max_tokens) / 2 * (1 / 0.75))
+    for page in pages:
+        words = re.split(r'\s+', page["text"].strip())
+        for i in range(0, len(words), target_words):
+            yield { "text": ' '.join(words[i:i + target_words]), "pageNumber": page["pageNumber"] }
+
+
+def embedded_part(tokenizer, texts):
+    """Each text cut to what the model sees, so facts past the truncation point don't count."""
+    limit = MAX_SEQ_LENGTH - 2
+    enc = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+    out, over = [], 0
+    for text, offsets in zip(texts, enc['offset_mapping']):
+        if len(offsets) > limit:
+            over += 1
+            text = text[:offsets[limit - 1][1]]
+        out.append(text)
+    return out, over
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=100)
+    parser.add_argument('--facts', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    pages, facts = synthetic_corpus(args.docs, args.facts)
+    corpus_mb = sum(len(p["text"]) for p in pages) / 2**20
+    tokenizer = get_tokenizer()
+    queries = _encode([question for _, question in facts])
+
+    print(f"{len(pages)} pages ({corpus_mb:.1f}MB), {len(facts)} facts, k={args.k}, "
+          f"chunk budget {CHUNK_MAX_TOKENS} tokens, overlap {CHUNK_OVERLAP_TOKENS}")
+    print(f"{'chunker':<10} {'chunks':>7} {'chunks/s':>9} {'MB/s':>7} {'>window':>8} {'recall@k':>9}")
+    chunkers = {
+        'words': lambda: word_windows(pages),
+        'tokens': lambda: iter_chunks(pages),
+    }
+    for name, chunker in chunkers.items():
+        start = time.perf_counter()
+        chunks = [c["text"] for c in chunker()]
+        elapsed = time.perf_counter() - start
+
+        seen, over = embedded_part(tokenizer, chunks)
+        embs = _encode(chunks)
+        top = np.argsort(-(queries @ embs.T), axis=1)[:, :args.k]
+        recall = np.mean([any(fact in seen[j] for j in row) for (fact, _), row in zip(facts, top)])
+
+        print(f"{name:<10} {len(chunks):>7} {len(chunks) / elapsed:>9.0f} {corpus_mb / elapsed:>7.2f} "
+              f"{over / len(chunks):>7.0%} {recall:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Resident index size and query latency across rounds of ingest, delete and
+compaction of one user's store (services/faiss_index.py), in a scratch
+indexes/ directory.
+
+    FAISS_INDEX_TYPE=hnsw python benchmarks/bench_compaction.py --rounds 5 --docs 4 --chunks 100
+
+Each round adds a document, deletes the oldest one and compacts. Indexes
+that can't remove ids (hnsw) keep deleted vectors until compaction
+replaces them; the script checks that after every compaction the resident
+index holds exactly the live vectors, and exits non-zero if it doesn't.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# faiss_index keeps its stores under the working directory
+os.chdir(tempfile.mkdtemp(prefix='bench-compaction-'))
+
+from services import faiss_index
+from services.faiss_index import add_chunks_to_index, compact_user_index, delete_document_vectors, search_user_index_batch
+
+USER = 'bench-user'
+
+
+def add_document(docId, n_chunks, dim, rng):
+    vectors = rng.standard_normal((n_chunks, dim)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    chunks = [{ 'chunkId': f'{docId}-{i}', 'text': '', 'pageNumber': 1, 'order': i } for i in range(n_chunks)]
+    add_chunks_to_index(USER, docId, chunks, vectors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--docs', type=int, default=4, help='documents kept live')
+    parser.add_argument('--chunks', type=int, default=100, help='vectors per document')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    xq = rng.standard_normal((args.queries, args.dim)).astype('float32')
+    xq /= np.linalg.norm(xq, axis=1, keepdims=True)
+
+    docs = []
+    for n in range(args.docs):
+        docs.append(f'doc-{n}')
+        add_document(docs[-1], args.chunks, args.dim, rng)
+    compact_user_index(USER, force=True)
+
+    print(f"{args.docs} live documents x {args.chunks} vectors, {args.rounds} rounds")
+    print(f"{'round':>5} {'kind':>6} {'ntotal':>7} {'dead':>6} {'live':>6} {'p50 ms':>8}")
+    failed = False
+    for round_ in range(1, args.rounds + 1):
+        docs.append(f'doc-{args.docs + round_ - 1}')
+        add_document(docs[-1], args.chunks, args.dim, rng)
+        delete_document_vectors(USER, docs.pop(0))
+        compact_user_index(USER)
+
+        times = []
+        for q in xq:
+            start = time.perf_counter()
+            search_user_index_batch(USER, q[None, :], args.k)
+            times.append((time.perf_counter() - start) * 1000)
+        index, _ = faiss_index._load_user_index(USER)
+        live = args.docs * args.chunks
+        print(f"{round_:>5} {index.kind:>6} {index.index.ntotal:>7} {len(index.dead):>6} {index.ntotal:>6} {statistics.median(times):>8.2f}")
+        failed |= index.index.ntotal != live or index.ntotal != live
+
+    if failed:
+        print("✗ Compaction left removed vectors in the resident index")
+        sys.exit(1)
+    print("✓ Resident index holds only the live vectors after every compaction")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Parity and throughput of the embedding backends: PyTorch sentence-transformers
+vs the int8 ONNX Runtime export (services/onnx_embedder.py).
+
+    python benchmarks/bench_embedding_backends.py --texts 2000 --batch-size 32
+    python benchmarks/bench_embedding_backends.py --file chunks.txt   # one text per line
+
+Reports the cosine similarity between the two backends' embeddings of the
+same texts (min / mean / p1) and texts per second for each, single-query
+latency included. Exits non-zero when the mean cosine falls below
+--min-cosine, so it can gate a switch of EMBEDDING_BACKEND.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.embeddings import MODEL_NAME
+from services.onnx_embedder import OnnxEmbedder
+
+WORDS = ('document invoice payment contract clause section report revenue quarter policy '
+         'employee benefit insurance claim deadline meeting schedule project budget summary '
+         'customer order delivery warranty refund account balance statement tax agreement').split()
+
+
+def synthetic_texts(n, seed=0):
+    """Sentences of 5 to 120 words, roughly the spread of real chunks and queries."""
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 120))) for _ in range(n)]
+
+
+def normalized(embs):
+    embs = np.asarray(embs, dtype='float32')
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embs / norms
+
+
+def throughput(model, texts, batch_size):
+    model.encode(texts[:batch_size], batch_size=batch_size, show_progress_bar=False)  # warm up
+    start = time.perf_counter()
+    embs = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+    elapsed = time.perf_counter() - start
+    latencies = []
+    for text in texts[:50]:
+        t0 = time.perf_counter()
+        model.encode([text], batch_size=1, convert_to_numpy=True, show_progress_bar=False)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return normalized(embs), len(texts) / elapsed, np.percentile(latencies, 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--texts', type=int, default=1000)
+    parser.add_argument('--file', help='read texts from this file, one per line')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--min-cosine', type=float, default=0.99)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'r', encoding='utf8') as f:
+            texts = [line.strip() for line in f if line.strip()][:args.texts]
+    else:
+        texts = synthetic_texts(args.texts)
+
+    from sentence_transformers import SentenceTransformer
+    backends = {
+        'torch': SentenceTransformer(MODEL_NAME),
+        'onnx-int8': OnnxEmbedder(MODEL_NAME),
+    }
+
+    print(f"{len(texts)} texts, batch size {args.batch_size}")
+    print(f"{'backend':<10} {'texts/s':>9} {'p50 1-text ms':>14}")
+    results = {}
+    for name, model in backends.items():
+        embs, rate, p50 = throughput(model, texts, args.batch_size)
+        results[name] = embs
+        print(f"{name:<10} {rate:>9.1f} {p50:>14.2f}")
+
+    cosine = np.sum(results['torch'] * results['onnx-int8'], axis=1)
+    print(f"cosine torch vs onnx-int8: min {cosine.min():.4f}  p1 {np.percentile(cosine, 1):.4f}  mean {cosine.mean():.4f}")
+    if cosine.mean() < args.min_cosine:
+        print(f"FAIL: mean cosine below {args.min_cosine}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
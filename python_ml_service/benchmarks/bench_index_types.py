@@ -0,0 +1,84 @@
+"""
+Compare FAISS index types on a synthetic corpus: build time, query latency,
+recall@k against exact (flat) search, and approximate resident size.
+
+    python benchmarks/bench_index_types.py --n 200000 --dim 384 --kinds flat,ivf,hnsw,ivfpq
+    python benchmarks/bench_index_types.py --kinds flat,fp16,sq8 --rescore 4
+
+--rescore N adds a row per type that fetches N * k candidates and re-ranks
+them with the float32 vectors, as FAISS_RESCORE_FACTOR does in the service.
+
+Index parameters come from the same FAISS_* environment variables the
+service reads (see services/index_factory.py).
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.index_factory import UserIndex, build_index, rescore
+
+
+def synthetic_corpus(n, dim, n_queries, seed=0):
+    """Normalized vectors around a few hundred centres, like embeddings of related documents."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(1, n // 500), dim)).astype('float32')
+    xb = centres[rng.integers(0, len(centres), n)] + 0.5 * rng.standard_normal((n, dim)).astype('float32')
+    xq = centres[rng.integers(0, len(centres), n_queries)] + 0.5 * rng.standard_normal((n_queries, dim)).astype('float32')
+    xb /= np.linalg.norm(xb, axis=1, keepdims=True)
+    xq /= np.linalg.norm(xq, axis=1, keepdims=True)
+    return xb, xq
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--kinds', default='flat,fp16,sq8,ivf,hnsw,ivfpq')
+    parser.add_argument('--rescore', type=int, default=0, help='re-rank N * k candidates with float32 vectors')
+    args = parser.parse_args()
+
+    xb, xq = synthetic_corpus(args.n, args.dim, args.queries)
+    ids = np.arange(1, args.n + 1, dtype='int64')
+    truth = None
+
+    print(f"n={args.n} dim={args.dim} queries={args.queries} k={args.k}")
+    print(f"{'kind':<8} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7} {'MB':>8}")
+    for kind in ['flat'] + [k for k in args.kinds.split(',') if k != 'flat']:
+        start = time.perf_counter()
+        index = UserIndex(build_index(kind, [(ids, xb)], args.dim))
+        build_s = time.perf_counter() - start
+
+        variants = [(kind, 0)]
+        if args.rescore > 1 and kind != 'flat':
+            variants.append((f'{kind}+rs', args.rescore))
+        for label, factor in variants:
+            latencies = []
+            found = []
+            for q in xq:
+                start = time.perf_counter()
+                if factor:
+                    _, I = index.search(q[None, :], args.k * factor)
+                    _, I = rescore([(ids, xb)], q[None, :], I, args.k)
+                else:
+                    _, I = index.search(q[None, :], args.k)
+                latencies.append((time.perf_counter() - start) * 1000)
+                found.append(I[0])
+            found = np.array(found)
+
+            if truth is None:
+                truth = found
+            recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+            if kind == 'flat' and 'flat' not in args.kinds.split(','):
+                continue
+            print(f"{label:<8} {build_s:>8.2f} {np.percentile(latencies, 50):>8.2f} "
+                  f"{np.percentile(latencies, 95):>8.2f} {recall:>7.3f} {index.nbytes() / 2**20:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
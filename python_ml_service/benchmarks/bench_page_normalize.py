@@ -0,0 +1,100 @@
+"""
+Regression check for per-page text normalization (utils/pdf_pages.py).
+
+The old extraction appended each text element to the page string and
+re-ran both regexes over the whole string every time, so dense pages cost
+O(elements x page length). This times that approach and clean_page_text
+on synthetic pages of growing element counts, with no PDF parsing involved.
+
+    python benchmarks/bench_page_normalize.py --elements 250,500,1000,2000,4000
+
+Exits non-zero if the outputs differ, or if time per element for
+clean_page_text grows more than --max-growth times between the smallest
+and largest page (it should stay roughly flat).
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdfminer.layout import LTTextContainer
+from utils.pdf_pages import clean_page_text
+
+WORDS = ('document invoice payment contract clause section report revenue quarter policy '
+         'employee benefit insurance claim deadline meeting schedule project budget summary').split()
+
+
+class TextBox(LTTextContainer):
+    """A layout element with fixed text, standing in for pdfminer's text boxes."""
+    def __init__(self, text):
+        super().__init__()
+        self._text = text
+
+    def get_text(self):
+        return self._text
+
+
+def dense_page(n_elements, seed=0):
+    rng = random.Random(seed)
+    page = []
+    for i in range(n_elements):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(4, 14))]
+        if i % 50 == 0:
+            words.insert(0, 'C O N F I D E N T I A L')
+        page.append(TextBox(' '.join(words) + '\n'))
+    return page
+
+
+def quadratic_clean(page_layout):
+    """The previous per-element normalization, kept for comparison."""
+    page_text = ""
+    for element in page_layout:
+        if isinstance(element, LTTextContainer):
+            page_text += element.get_text()
+            page_text = re.sub(r'\s+', ' ', page_text)
+            page_text = re.sub(r'([A-Z]\s){3,}', '', page_text)
+    return page_text.strip()
+
+
+def best_of(fn, page, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(page)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--elements', default='250,500,1000,2000')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-growth', type=float, default=3.0)
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.elements.split(',')]
+    print(f"{'elements':>9} {'old ms':>9} {'new ms':>9} {'new us/elem':>12} {'speedup':>8}")
+    per_element = []
+    for n in sizes:
+        page = dense_page(n)
+        old, old_s = best_of(quadratic_clean, page, 1)
+        new, new_s = best_of(clean_page_text, page, args.repeats)
+        if old != new:
+            print(f"FAIL: output differs at {n} elements")
+            sys.exit(1)
+        per_element.append(new_s / n)
+        print(f"{n:>9} {old_s * 1000:>9.1f} {new_s * 1000:>9.2f} {new_s / n * 1e6:>12.2f} {old_s / new_s:>7.0f}x")
+
+    growth = per_element[-1] / per_element[0]
+    print(f"per-element cost growth {sizes[0]} -> {sizes[-1]} elements: {growth:.2f}x")
+    if growth > args.max_growth:
+        print(f"FAIL: clean_page_text scales worse than linearly (>{args.max_growth}x)")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
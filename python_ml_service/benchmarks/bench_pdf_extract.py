@@ -0,0 +1,97 @@
+"""
+Serial vs process-pool PDF text extraction (utils/pdf_pages.py) on a
+synthetic multi-page PDF.
+
+    python benchmarks/bench_pdf_extract.py --pages 400
+    python benchmarks/bench_pdf_extract.py --file big.pdf --pages-per-task 16
+
+The pool size comes from PDF_EXTRACT_WORKERS. Pages are checked to be
+identical and in the same order on both paths; the script exits non-zero
+if they differ.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import pdf_pages
+
+WORDS = ('document invoice payment contract clause section report revenue quarter policy '
+         'employee benefit insurance claim deadline meeting schedule project budget summary').split()
+
+
+def synthetic_pdf(n_pages, lines_per_page=55, seed=0) -> bytes:
+    """A plain PDF with n_pages pages of Helvetica text lines."""
+    rng = random.Random(seed)
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        ('<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join(f'{4 + 2 * i} 0 R' for i in range(n_pages)), n_pages)).encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for i in range(n_pages):
+        lines = [' '.join(rng.choice(WORDS) for _ in range(12)) for _ in range(lines_per_page)]
+        stream = '\n'.join(['BT /F1 10 Tf 40 800 Td 13 TL'] + [f'({line}) Tj T*' for line in lines] + ['ET']).encode()
+        objects.append(('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] '
+                        '/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (5 + 2 * i)).encode())
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def timed(pages_iter):
+    start = time.perf_counter()
+    pages = list(pages_iter)
+    return pages, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=300)
+    parser.add_argument('--file', help='benchmark this PDF instead of a synthetic one')
+    parser.add_argument('--pages-per-task', type=int, default=pdf_pages.PDF_PAGES_PER_TASK)
+    args = parser.parse_args()
+
+    path = args.file
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(synthetic_pdf(args.pages))
+    try:
+        n_pages = pdf_pages.count_pages(path)
+        print(f"{n_pages} pages, {os.path.getsize(path) / 2**20:.1f}MB, "
+              f"{pdf_pages.PDF_EXTRACT_WORKERS} workers, {args.pages_per_task} pages per task")
+
+        serial, serial_s = timed(pdf_pages.iter_pdf_pages(path))
+        # Start the pool outside the timing, as it would be in a running service
+        list(pdf_pages.iter_pdf_pages_parallel(path, pages_per_task=max(1, n_pages)))
+        parallel, parallel_s = timed(pdf_pages.iter_pdf_pages_parallel(path, n_pages, args.pages_per_task))
+
+        print(f"{'mode':<10} {'s':>8} {'pages/s':>9}")
+        print(f"{'serial':<10} {serial_s:>8.2f} {n_pages / serial_s:>9.1f}")
+        print(f"{'parallel':<10} {parallel_s:>8.2f} {n_pages / parallel_s:>9.1f}")
+        print(f"speedup {serial_s / parallel_s:.2f}x")
+
+        if serial != parallel:
+            print("FAIL: parallel extraction differs from serial")
+            sys.exit(1)
+    finally:
+        if not args.file:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
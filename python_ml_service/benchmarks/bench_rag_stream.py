@@ -0,0 +1,106 @@
+"""
+Time to first token of the streamed RAG answer (services/langchain_rag.py
+stream_answer, as served by /query-rag-stream) vs the blocking
+generate_answer behind /query-rag, against the local fake LLM
+(benchmarks/fake_llm_server.py), so no network or API key is needed.
+
+    python benchmarks/bench_rag_stream.py --requests 20 --concurrency 4 --first-token-ms 400 --token-ms 20
+
+Requests go through the same bounded network executor as the service.
+For the blocking path the first token reaches the client together with
+the last one. The streamed answer, sources and confidence are checked to
+match the blocking ones; the script exits non-zero if they differ.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai
+from benchmarks import fake_llm_server
+from services.executors import run, run_iter
+from services.langchain_rag import generate_answer, stream_answer
+
+CONTEXT = [
+    "[1] contract.pdf (Page 2)\nEither party may terminate with thirty days written notice.",
+    "[2] policy.pdf (Page 5)\nRefunds are issued within fourteen days of the request.",
+]
+SOURCES = [
+    { "number": 1, "chunkId": "c1", "docName": "contract.pdf", "pageNumber": 2, "snippet": "Either party may terminate" },
+    { "number": 2, "chunkId": "c2", "docName": "policy.pdf", "pageNumber": 5, "snippet": "Refunds are issued" },
+]
+HITS = [{ "similarity": 0.82 }, { "similarity": 0.74 }]
+
+
+async def blocking_request():
+    start = time.perf_counter()
+    result = await run('network', generate_answer, "How do I cancel?", "neutral", [], CONTEXT, SOURCES, HITS)
+    elapsed = time.perf_counter() - start
+    result.pop("usage")
+    return elapsed, elapsed, result
+
+
+async def streamed_request():
+    start = time.perf_counter()
+    first = None
+    async for event, data in run_iter('network', stream_answer("How do I cancel?", "neutral", [], CONTEXT, SOURCES, HITS)):
+        if event == "token" and first is None:
+            first = time.perf_counter() - start
+        elif event == "done":
+            data.pop("usage")
+            result = data
+    return first, time.perf_counter() - start, result
+
+
+async def measure(request, n_requests, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with limit:
+            return await request()
+
+    return await asyncio.gather(*[one() for _ in range(n_requests)])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--first-token-ms', type=float, default=400)
+    parser.add_argument('--token-ms', type=float, default=20)
+    parser.add_argument('--tokens', type=int, default=60)
+    args = parser.parse_args()
+
+    server = fake_llm_server.start(0, args.first_token_ms, args.token_ms, args.tokens)
+    openai.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    openai.api_key = openai.api_key or "fake"
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, fake LLM: "
+          f"{args.first_token_ms:.0f}ms to first token + {args.token_ms:.0f}ms x {args.tokens} tokens")
+    print(f"{'path':<10} {'ttft p50':>9} {'ttft p95':>9} {'total p50':>10}")
+    outcomes = {}
+    for name, request in (('blocking', blocking_request), ('streamed', streamed_request)):
+        rows = asyncio.run(measure(request, args.requests, args.concurrency))
+        ttft = [r[0] * 1000 for r in rows]
+        total = [r[1] * 1000 for r in rows]
+        outcomes[name] = [r[2] for r in rows]
+        print(f"{name:<10} {statistics.median(ttft):>7.0f}ms {percentile(ttft, 0.95):>7.0f}ms {statistics.median(total):>8.0f}ms")
+    server.shutdown()
+
+    if any(r != outcomes['blocking'][0] for r in outcomes['blocking'] + outcomes['streamed']):
+        print("✗ Streamed answers differ from the blocking ones")
+        sys.exit(1)
+    print("✓ Streamed and blocking answers match")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+A local stand-in for the OpenAI chat completions API, for offline
+benchmarks and manual testing of the streaming endpoints.
+
+    python benchmarks/fake_llm_server.py --port 8089 --first-token-ms 400 --token-ms 20
+    OPENAI_API_BASE=http://127.0.0.1:8089/v1 OPENAI_API_KEY=x uvicorn main:app
+
+POST /v1/chat/completions answers every request with the same canned,
+cited answer after --first-token-ms (prompt processing), then one token
+every --token-ms. With "stream": true the tokens are sent as they are
+"generated", in the API's server-sent events format; otherwise the full
+completion is returned at the end.
+"""
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = ("The contract can be terminated with thirty days written notice [1]. "
+          "Refunds are issued within fourteen days of the request [2]. "
+          "Late payments accrue interest at two percent per month [1].")
+
+
+def answer_tokens(n_tokens: int):
+    """The canned answer as word-level tokens, repeated or cut to n_tokens."""
+    words = ANSWER.split(' ')
+    return [(' ' if i else '') + words[i % len(words)] for i in range(n_tokens)]
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    first_token_ms = 400
+    token_ms = 20
+    n_tokens = 60
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        model = body.get('model', 'fake')
+        tokens = answer_tokens(min(self.n_tokens, body.get('max_tokens') or self.n_tokens))
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // 4
+        time.sleep(self.first_token_ms / 1000)
+        if body.get('stream'):
+            try:
+                self._stream(model, tokens)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client stopped reading
+        else:
+            time.sleep(self.token_ms * len(tokens) / 1000)
+            self._send_json({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{ 'index': 0, 'message': { 'role': 'assistant', 'content': ''.join(tokens) }, 'finish_reason': 'stop' }],
+                'usage': { 'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens), 'total_tokens': prompt_tokens + len(tokens) },
+            })
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, model, tokens):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(delta, finish_reason=None):
+            return { 'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                     'choices': [{ 'index': 0, 'delta': delta, 'finish_reason': finish_reason }] }
+
+        events = [chunk({ 'role': 'assistant' })]
+        events += [chunk({ 'content': token }) for token in tokens]
+        events.append(chunk({}, 'stop'))
+        for i, event in enumerate(events):
+            if i > 1:
+                time.sleep(self.token_ms / 1000)
+            self._write_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf8'))
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+
+def start(port: int = 0, first_token_ms: float = 400, token_ms: float = 20, n_tokens: int = 60):
+    """Serve on a background thread; returns the server (its URL base is http://127.0.0.1:<port>/v1)."""
+    handler = type('Handler', (FakeLLMHandler,), {
+        'first_token_ms': first_token_ms, 'token_ms': token_ms, 'n_tokens': n_tokens,
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--first-token-ms', type=float, default=400)
+    parser.add_argument('--token-ms', type=float, default=20)
+    parser.add_argument('--tokens', type=int, default=60)
+    args = parser.parse_args()
+
+    server = start(args.port, args.first_token_ms, args.token_ms, args.tokens)
+    print(f"✓ Fake LLM on http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,17 @@ This will delete all vectors, FAISS index, and reset meta.json.
 """
 import os
 import json
+import shutil
 import sys
 
+from services.faiss_index import _relocate_user, _user_path, list_user_ids
+
 def clear_user_storage(userId: str):
     """Clear all FAISS storage for a user"""
-    base_path = os.path.join(os.getcwd(), 'indexes', userId)
+    base_path = _user_path(userId)
+    if not os.path.isdir(base_path) and userId in list_user_ids():
+        # Left where an earlier FAISS_NUM_SHARDS put it
+        _relocate_user(userId, base_path)
     
     if not os.path.exists(base_path):
         print(f"No storage found for userId: {userId}")
@@ -17,6 +23,8 @@ def clear_user_storage(userId: str):
     index_path = os.path.join(base_path, 'index.faiss')
     meta_path = os.path.join(base_path, 'meta.json')
     vectors_path = os.path.join(base_path, 'vectors.npy')
+    manifest_path = os.path.join(base_path, 'manifest.json')
+    segments_path = os.path.join(base_path, 'segments')
     
     # Remove files
     removed = []
@@ -27,6 +35,14 @@ def clear_user_storage(userId: str):
     if os.path.exists(vectors_path):
         os.remove(vectors_path)
         removed.append('vectors.npy')
+
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+        removed.append('manifest.json')
+
+    if os.path.exists(segments_path):
+        shutil.rmtree(segments_path)
+        removed.append('segments/')
     
     # Reset meta.json
     with open(meta_path, 'w', encoding='utf-8') as f:
@@ -1,7 +1,9 @@
 import os
 import io
+import json
 import shutil
 import tempfile
+import threading
 from typing import List
 
 from dotenv import load_dotenv
@@ -9,13 +11,20 @@ load_dotenv()
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from services.document_processor import process_document
-from services.faiss_index import delete_document_vectors, search_user_index
+from services.document_processor import process_document, get_ingest_progress
+from services.faiss_index import FORWARDED_WORKLOADS, delete_document_vectors, search_user_index, get_index_cache_stats, preload_owned_users, serve_forwarded
+from services.shard_router import NUM_SHARDS, shard_stats
+from services.embeddings import get_embedding_cache_stats, get_embedding_batcher_stats
 from services.whisper_ser import transcribe_and_emotion
 from services.text_emotion import detect_text_emotion, learn_emotion_pattern
-from services.langchain_rag import query_rag
+from services.langchain_rag import query_rag, query_rag_batch, query_rag_stream
+from services.reindex import reindex_user
+from services.executors import run, executor_stats
+from services.dedup import dedup_stats
+from services.answer_cache import answer_cache_stats
 
 app = FastAPI(title='DocVoice-Agent ML Service')
 
@@ -43,6 +52,21 @@ class QueryRequest(BaseModel):
     query: str
     emotion: str = 'neutral'
     history: list = []
+    docIds: list = None
+
+
+class QueryBatchRequest(BaseModel):
+    userId: str
+    queries: List[str]
+    emotion: str = 'neutral'
+    history: list = []
+    docIds: list = None
+    topK: int = 5
+    generate: bool = False
+
+
+class ReindexRequest(BaseModel):
+    userId: str
 
 
 class EmotionFeedbackRequest(BaseModel):
@@ -52,21 +76,100 @@ class EmotionFeedbackRequest(BaseModel):
     correct_emotion: str
 
 
+@app.on_event('startup')
+async def preload_owned_shards():
+    # Keep this node's shards resident; runs in the background so startup isn't blocked
+    if NUM_SHARDS > 1 and os.environ.get('FAISS_PRELOAD_OWNED', '1') == '1':
+        threading.Thread(target=preload_owned_users, name='faiss-preload', daemon=True).start()
+
+
 @app.post('/process-document')
 async def api_process_document(req: ProcessRequest):
     try:
         chunks = await process_document(req.docId, req.userId, req.fileUrl)
         return { 'chunks': chunks }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get('/ingest-progress/{docId}')
+async def api_ingest_progress(docId: str):
+    progress = get_ingest_progress(docId)
+    if progress is None:
+        raise HTTPException(status_code=404, detail='No ingest in progress or recently finished for this docId')
+    return progress
+
+
 @app.post('/delete-document')
 async def api_delete_document(req: DeleteRequest):
     try:
-        # delete_document_vectors is a synchronous function, do not await it
-        delete_document_vectors(req.userId, req.docId)
+        # delete_document_vectors is synchronous; run it on the disk pool
+        await run('disk', delete_document_vectors, req.userId, req.docId)
         return { 'ok': True }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post('/reindex-user')
+async def api_reindex_user(req: ReindexRequest):
+    # Long-running and blocking; runs on the disk pool
+    try:
+        return await run('disk', reindex_user, req.userId)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get('/index-cache-stats')
+async def api_index_cache_stats():
+    return get_index_cache_stats()
+
+
+@app.get('/embedding-cache-stats')
+async def api_embedding_cache_stats():
+    return get_embedding_cache_stats()
+
+
+@app.get('/embedding-batcher-stats')
+async def api_embedding_batcher_stats():
+    return get_embedding_batcher_stats()
+
+
+@app.get('/dedup-stats')
+async def api_dedup_stats():
+    return dedup_stats()
+
+
+@app.get('/answer-cache-stats')
+async def api_answer_cache_stats():
+    return answer_cache_stats()
+
+
+@app.get('/executor-stats')
+async def api_executor_stats():
+    return executor_stats()
+
+
+@app.get('/shard-stats')
+async def api_shard_stats():
+    return shard_stats()
+
+
+@app.post('/internal/index/{op}')
+async def api_internal_index(op: str, payload: dict):
+    # Index calls forwarded by another node's shard router, on the same pools as local ones
+    workload = FORWARDED_WORKLOADS.get(op)
+    if workload is None:
+        raise HTTPException(status_code=404, detail=f'Unknown index operation: {op}')
+    try:
+        return { 'result': await run(workload, serve_forwarded, op, payload) }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -77,6 +180,8 @@ async def api_voice_to_text_emotion(file: UploadFile = File(...)):
         audio_bytes = await file.read()
         result = await transcribe_and_emotion(audio_bytes)
         return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -84,8 +189,10 @@ async def api_voice_to_text_emotion(file: UploadFile = File(...)):
 @app.post('/text-emotion')
 async def api_text_emotion(req: QueryRequest):
     try:
-        result = detect_text_emotion(req.query)
+        result = await run('cpu', detect_text_emotion, req.query)
         return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -93,8 +200,65 @@ async def api_text_emotion(req: QueryRequest):
 @app.post('/query-rag')
 async def api_query_rag(req: QueryRequest):
     try:
-        ans = await query_rag(req.userId, req.query, req.emotion, req.history)
+        ans = await query_rag(req.userId, req.query, req.emotion, req.history, req.docIds)
         return ans
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _sse_events(first, events):
+    event, data = first
+    try:
+        while True:
+            yield _sse(event, { 'text': data } if event == 'token' else data)
+            event, data = await events.__anext__()
+    except StopAsyncIteration:
+        pass
+    except Exception as e:
+        # Headers are already sent, so failures mid-answer are reported in-stream
+        yield _sse('error', { 'detail': getattr(e, 'detail', None) or str(e) })
+    finally:
+        await events.aclose()
+
+
+@app.post('/query-rag-stream')
+async def api_query_rag_stream(req: QueryRequest):
+    """
+    /query-rag as server-sent events: one `token` event per piece of the
+    answer as the LLM produces it, then a `done` event with answer, sources
+    and confidence (or an `error` event).
+    """
+    try:
+        events = await query_rag_stream(req.userId, req.query, req.emotion, req.history, req.docIds)
+        # Wait for the first event so retrieval/LLM failures still get a proper status code
+        first = await events.__anext__()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(
+        _sse_events(first, events),
+        media_type='text/event-stream',
+        headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' },
+    )
+
+
+@app.post('/query-batch')
+async def api_query_batch(req: QueryBatchRequest):
+    try:
+        results = await query_rag_batch(
+            req.userId, req.queries, req.emotion, req.history, req.docIds,
+            top_k=req.topK, generate=req.generate
+        )
+        return { 'results': results }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -103,8 +267,10 @@ async def api_query_rag(req: QueryRequest):
 async def api_emotion_feedback(req: EmotionFeedbackRequest):
     try:
         # Learn from user feedback
-        learn_emotion_pattern(req.text, req.correct_emotion)
+        await run('disk', learn_emotion_pattern, req.text, req.correct_emotion)
         return {'status': 'learned', 'text': req.text, 'learned_emotion': req.correct_emotion}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,33 @@
+"""
+One-shot migration of FAISS metadata from meta.json to the columnar format.
+Every store under indexes/ (or only the given users) that still has JSON
+metadata is rewritten into a single compacted base segment. Stores that are
+already columnar are left alone, so the script is safe to re-run.
+"""
+import sys
+
+from services.faiss_index import BASE, list_user_ids, migrate_user_meta
+
+def migrate(user_ids):
+    migrated = 0
+    for userId in user_ids:
+        try:
+            if migrate_user_meta(userId):
+                migrated += 1
+                print(f"✓ Migrated userId: {userId}")
+            else:
+                print(f"- Already columnar: {userId}")
+        except Exception as e:
+            print(f"✗ Failed userId: {userId}: {e}")
+    print(f"\nMigrated {migrated}/{len(user_ids)} stores")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        user_ids = sys.argv[1:]
+    else:
+        user_ids = list_user_ids()
+    if not user_ids:
+        print("Usage: python migrate_meta_store.py [userId ...]")
+        print("No stores found under", BASE)
+        sys.exit(0)
+    migrate(user_ids)
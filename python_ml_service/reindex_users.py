@@ -0,0 +1,29 @@
+"""
+Re-embed users' whole corpora from the MongoDB chunks collection and rebuild
+their FAISS vectors (e.g. after changing the embedding model or backend).
+Set EMBED_POOL_WORKERS to spread the embedding over that many processes.
+
+    EMBED_POOL_WORKERS=8 python reindex_users.py userId [userId ...]
+"""
+import sys
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from services.reindex import reindex_user
+
+def reindex(user_ids):
+    done = 0
+    for userId in user_ids:
+        try:
+            reindex_user(userId)
+            done += 1
+        except Exception as e:
+            print(f"✗ Failed userId: {userId}: {e}")
+    print(f"\nReindexed {done}/{len(user_ids)} users")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python reindex_users.py userId [userId ...]")
+        sys.exit(0)
+    reindex(sys.argv[1:])
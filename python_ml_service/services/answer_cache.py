@@ -0,0 +1,139 @@
+"""
+Per-user semantic cache of RAG answers.
+
+An answer is reused when a later query of the same user
+- has the same emotion and recent conversation history,
+- retrieves exactly the same set of relevant chunkIds, and
+- has an embedding within ANSWER_CACHE_MIN_SIMILARITY (cosine) of the
+  cached query's.
+
+A hit skips the MongoDB lookup and the LLM call; embedding and FAISS search
+still run, since the retrieved chunks are part of the key. chunkIds are
+never reused for other text, so the same set means the same context.
+
+Writes to a user's index (faiss_index add/link/delete) drop that user's
+answers and bump their generation. An answer computed while the index
+changed under it isn't stored. Writes made by other worker processes or
+nodes aren't seen here; ANSWER_CACHE_TTL_SECONDS bounds how long such an
+answer can be served.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE', '1') == '1'
+ANSWER_CACHE_MIN_SIMILARITY = float(os.environ.get('ANSWER_CACHE_MIN_SIMILARITY', 0.95))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 256))  # per user
+ANSWER_CACHE_MAX_USERS = int(os.environ.get('ANSWER_CACHE_MAX_USERS', 1000))
+
+# userId -> OrderedDict of entries, least recently used first
+_answers = OrderedDict()
+# userId -> number of index writes seen by this process
+_generations = {}
+_lock = threading.Lock()
+
+_stats = {
+    'lookups': 0,
+    'hits': 0,
+    'stores': 0,
+    'stale_stores': 0,
+    'invalidations': 0,
+    'tokens_saved': 0,
+}
+
+
+def _key(emotion, history, chunk_ids):
+    # The prompt only uses the last 8 history messages (generate_answer)
+    recent = json.dumps(history[-8:] if history else [], sort_keys=True, default=str)
+    return ((emotion or 'neutral').lower(), recent, frozenset(chunk_ids))
+
+
+def generation(userId: str) -> int:
+    """Take before retrieval and pass to store(), so answers raced by an index write are dropped."""
+    with _lock:
+        return _generations.get(userId, 0)
+
+
+def invalidate(userId: str):
+    """The user's index changed: forget their answers."""
+    with _lock:
+        _generations[userId] = _generations.get(userId, 0) + 1
+        if _answers.pop(userId, None) is not None:
+            _stats['invalidations'] += 1
+
+
+def lookup(userId: str, query_embedding, emotion, history, chunk_ids):
+    """A copy of a cached answer for this query and retrieval, or None."""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    key = _key(emotion, history, chunk_ids)
+    query_embedding = np.asarray(query_embedding, dtype='float32')
+    now = time.time()
+    with _lock:
+        _stats['lookups'] += 1
+        entries = _answers.get(userId)
+        if not entries:
+            return None
+        best, best_score = None, ANSWER_CACHE_MIN_SIMILARITY
+        for entry_id, entry in list(entries.items()):
+            if now - entry['time'] > ANSWER_CACHE_TTL_SECONDS:
+                del entries[entry_id]
+                continue
+            if entry['key'] != key:
+                continue
+            score = float(np.dot(entry['embedding'], query_embedding))
+            if score >= best_score:
+                best, best_score = entry_id, score
+        if best is None:
+            return None
+        entries.move_to_end(best)
+        _answers.move_to_end(userId)
+        entry = entries[best]
+        _stats['hits'] += 1
+        _stats['tokens_saved'] += entry['tokens']
+        return json.loads(entry['result'])
+
+
+def store(userId: str, generation_at_start: int, query_embedding, emotion, history, chunk_ids, result: dict, tokens: int = 0):
+    """Cache result (tokens: LLM tokens it cost) unless the user's index changed since generation_at_start."""
+    if not ANSWER_CACHE_ENABLED:
+        return
+    entry = {
+        'key': _key(emotion, history, chunk_ids),
+        'embedding': np.array(query_embedding, dtype='float32'),
+        # Serialized, so callers can't modify the cached answer
+        'result': json.dumps(result, default=str),
+        'tokens': int(tokens or 0),
+        'time': time.time(),
+    }
+    with _lock:
+        if _generations.get(userId, 0) != generation_at_start:
+            _stats['stale_stores'] += 1
+            return
+        entries = _answers.get(userId)
+        if entries is None:
+            entries = _answers[userId] = OrderedDict()
+            while len(_answers) > ANSWER_CACHE_MAX_USERS:
+                _answers.popitem(last=False)
+        _answers.move_to_end(userId)
+        entries[id(entry)] = entry
+        while len(entries) > ANSWER_CACHE_MAX_ENTRIES:
+            entries.popitem(last=False)
+        _stats['stores'] += 1
+
+
+def answer_cache_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+        stats['users'] = len(_answers)
+        stats['entries'] = sum(len(entries) for entries in _answers.values())
+    stats['enabled'] = ANSWER_CACHE_ENABLED
+    stats['min_similarity'] = ANSWER_CACHE_MIN_SIMILARITY
+    stats['misses'] = stats['lookups'] - stats['hits']
+    stats['hit_rate'] = round(stats['hits'] / stats['lookups'], 4) if stats['lookups'] else 0.0
+    return stats
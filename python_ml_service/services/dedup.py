@@ -0,0 +1,128 @@
+"""
+Duplicate chunk detection at ingest time.
+
+Two checks, both cheap given what ingest already computes:
+
+- Within a document, chunks whose normalized text (case and whitespace
+  folded) hashes the same as an earlier chunk aren't embedded or indexed
+  again; they reuse the earlier chunk's vector.
+- Across a user's documents, each new embedding is looked up in the
+  user's index (one batched top-1 search). A hit from another document at
+  cosine >= DEDUP_MIN_SIMILARITY is linked instead of indexed
+  (faiss_index.link_chunks_to_index): the new document references the
+  existing vector, which is only deleted once no document uses it. Re-uploads
+  of the same file hit the embedding cache, so linking costs no model time.
+  The index may be quantized (fp16/sq8/PQ), so near hits are compared
+  against the stored float32 vectors before linking.
+
+Ingest (services/document_processor.py) and reindexing (services/reindex.py)
+both go through split_repeats, find_indexed_duplicates and link_duplicates.
+
+The default threshold only matches text that is identical up to case and
+whitespace; lowering it also links near-duplicates, at the risk of
+treating a revised figure as unchanged.
+"""
+import os
+import hashlib
+import threading
+import numpy as np
+
+from services.faiss_index import link_chunks_to_index, search_user_index_batch, stored_vectors
+
+DEDUP_ENABLED = os.environ.get('INGEST_DEDUP', '1') == '1'
+DEDUP_MIN_SIMILARITY = float(os.environ.get('DEDUP_MIN_SIMILARITY', 0.9999))
+# Top-1 hits scoring at least DEDUP_MIN_SIMILARITY minus this are checked exactly
+CANDIDATE_MARGIN = 0.05
+
+_stats = {
+    'chunks': 0,
+    'duplicates_in_document': 0,
+    'duplicates_linked': 0,
+    'vectors_saved': 0,
+    'bytes_saved': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(' '.join(text.lower().split()).encode('utf8')).hexdigest()
+
+
+def split_repeats(chunk_objs, seen: dict):
+    """
+    Chunks to embed, and (chunk, earlier chunk) pairs for repeats of an
+    earlier chunk of the same document. seen maps text keys to chunks and
+    is kept across a document's batches.
+    """
+    unique, repeats = [], []
+    for obj in chunk_objs:
+        key = text_key(obj['text']) if DEDUP_ENABLED else None
+        if key is not None and key in seen:
+            repeats.append((obj, seen[key]))
+        else:
+            if key is not None:
+                seen[key] = obj
+            unique.append(obj)
+    return unique, repeats
+
+
+def find_indexed_duplicates(userId: str, docId: str, embeddings):
+    """Per embedding row, the [chunkId, faissIndex] of an indexed chunk of another document it duplicates, or None."""
+    hits = search_user_index_batch(userId, embeddings, top_k=1)
+    candidates = []
+    for i, row in enumerate(hits):
+        hit = row[0] if row else None
+        meta = (hit or {}).get('meta') or {}
+        if hit and hit['score'] >= DEDUP_MIN_SIMILARITY - CANDIDATE_MARGIN and str(meta.get('docId')) != str(docId):
+            candidates.append((i, meta.get('chunkId'), hit['faissIndex']))
+    found = [None] * len(hits)
+    if candidates:
+        # Scores from an fp16/sq8 or PQ index are approximate: compare the stored float32 vectors
+        exact = stored_vectors(userId, [eid for _, _, eid in candidates])
+        for (i, chunkId, eid), vector in zip(candidates, exact):
+            if len(vector) and float(np.dot(embeddings[i], vector)) >= DEDUP_MIN_SIMILARITY:
+                found[i] = [chunkId, eid]
+    return found
+
+
+def link_duplicates(userId: str, docId: str, unique, links):
+    """
+    Link the chunks of unique that have a duplicate in links (from
+    find_indexed_duplicates) to it, setting their faissIndex and
+    duplicateOf. Returns links with None where linking failed, so those
+    chunks are indexed instead.
+    """
+    pending = [i for i, link in enumerate(links) if link]
+    if not pending:
+        return links
+    links = list(links)
+    linked = link_chunks_to_index(userId, docId, [[unique[i]['chunkId'], links[i][1]] for i in pending])
+    for i, ok in zip(pending, linked):
+        if ok:
+            unique[i]['faissIndex'], unique[i]['duplicateOf'] = links[i][1], links[i][0]
+        else:
+            links[i] = None
+    return links
+
+
+def resolve_repeats(repeats):
+    for obj, original in repeats:
+        obj['faissIndex'], obj['duplicateOf'] = original['faissIndex'], original['chunkId']
+
+
+def record(chunks: int, in_document: int, linked: int, bytes_per_vector: int):
+    with _stats_lock:
+        _stats['chunks'] += chunks
+        _stats['duplicates_in_document'] += in_document
+        _stats['duplicates_linked'] += linked
+        _stats['vectors_saved'] += in_document + linked
+        _stats['bytes_saved'] += (in_document + linked) * bytes_per_vector
+
+
+def dedup_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['enabled'] = DEDUP_ENABLED
+    stats['min_similarity'] = DEDUP_MIN_SIMILARITY
+    stats['duplicate_ratio'] = round(stats['vectors_saved'] / stats['chunks'], 4) if stats['chunks'] else 0.0
+    return stats
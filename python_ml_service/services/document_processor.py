@@ -1,52 +1,163 @@
 import os
 import io
+import time
+import tempfile
+import threading
 import requests
 import uuid
+from collections import OrderedDict
 from typing import List
 
-from utils.text_utils import extract_text_from_file, chunk_text
-from services.embeddings import embed_texts
-from services.faiss_index import add_chunks_to_index
+from utils.text_utils import iter_chunks
+from utils.extractors import iter_file_sections
+from services.embeddings import embed_texts_async
+from services.faiss_index import add_chunks_to_index, delete_document_vectors
+from services.dedup import DEDUP_ENABLED, find_indexed_duplicates, link_duplicates, record, resolve_repeats, split_repeats
+from services.executors import admit, run_admitted
 
-async def process_document(docId: str, userId: str, fileUrl: str):
-    # download file
-    r = requests.get(fileUrl, stream=True, timeout=60)
-    r.raise_for_status()
-    content = r.content
-
-    # extract text
-    pages = extract_text_from_file(content, fileUrl)
+# Chunks embedded and appended to the index at a time; bounds memory for any file size
+INGEST_BATCH_CHUNKS = int(os.environ.get('INGEST_BATCH_CHUNKS', 256))
+INGEST_SPOOL_DIR = os.environ.get('INGEST_SPOOL_DIR') or None
+DOWNLOAD_BLOCK_BYTES = 1 << 20
+PROGRESS_MAX_ENTRIES = 1000
 
-    # chunk text
+# docId -> progress of its latest ingest (this process only), oldest first
+_progress = OrderedDict()
+_progress_lock = threading.Lock()
 
-    chunks = []
+def _set_progress(docId: str, **fields):
+    with _progress_lock:
+        entry = _progress.get(docId)
+        if entry is None:
+            entry = _progress[docId] = { 'docId': docId }
+            while len(_progress) > PROGRESS_MAX_ENTRIES:
+                _progress.popitem(last=False)
+        entry.update(fields, updatedAt=time.time())
 
-    for page in pages:
-        page_chunks = chunk_text(page["text"])
+def get_ingest_progress(docId: str):
+    """Progress of the latest ingest of docId on this process, or None."""
+    with _progress_lock:
+        entry = _progress.get(docId)
+        return dict(entry) if entry else None
 
-        for c in page_chunks:
-            chunks.append({
-                "text": c["text"],
-                "pageNumber": page["pageNumber"]
-            })
+def _spool(fileUrl: str, path: str, docId: str):
+    """Stream the file to path in fixed-size blocks."""
+    with requests.get(fileUrl, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        total = int(r.headers.get('Content-Length') or 0) or None
+        _set_progress(docId, bytesTotal=total)
+        done = 0
+        with open(path, 'wb') as f:
+            for block in r.iter_content(DOWNLOAD_BLOCK_BYTES):
+                f.write(block)
+                done += len(block)
+                _set_progress(docId, bytesDownloaded=done)
 
+def _next_page_chunks(pages):
+    """Extract and chunk the next page: (pageNumber, chunks), or None when done."""
+    page = next(pages, None)
+    if page is None:
+        return None
+    return page["pageNumber"], list(iter_chunks([page]))
 
-    # embed in batches
-    texts = [c['text'] for c in chunks]
-    embeddings = embed_texts(texts)
-
+async def _index_batch(docId: str, userId: str, chunks, start: int, seen: dict):
     # prepare chunk objects
     chunk_objs = []
-    for i, c in enumerate(chunks):
+    for i, c in enumerate(chunks, start=start):
         chunkId = c.get('chunkId') or f"{docId}-{i}-{uuid.uuid4().hex[:8]}"
         chunk_objs.append({ 'chunkId': chunkId, 'text': c['text'],'pageNumber': c['pageNumber'], 'order': i })
 
-    # add to FAISS
-    faiss_ids = add_chunks_to_index(userId, docId, chunk_objs, embeddings)
+    # Repeats of an earlier chunk of this document reuse its vector (seen spans all batches)
+    unique, repeats = split_repeats(chunk_objs, seen)
+
+    # embed in batches
+    embeddings = await embed_texts_async([obj['text'] for obj in unique], admitted=True) if unique else None
+
+    # Chunks identical to one already indexed for another document are linked to it
+    links = [None] * len(unique)
+    if DEDUP_ENABLED and unique:
+        links = await run_admitted('cpu', find_indexed_duplicates, userId, docId, embeddings)
+        links = await run_admitted('disk', link_duplicates, userId, docId, unique, links)
 
-    # return list
+    # add to FAISS (one delta segment per batch)
+    new = [i for i, link in enumerate(links) if not link]
+    if new:
+        faiss_ids = await run_admitted('disk', add_chunks_to_index, userId, docId, [unique[i] for i in new], embeddings[new])
+        for i, fid in zip(new, faiss_ids):
+            unique[i]['faissIndex'] = fid
+    resolve_repeats(repeats)
+
+    if DEDUP_ENABLED:
+        record(len(chunk_objs), len(repeats), len(unique) - len(new), embeddings.shape[1] * 4 if unique else 0)
+
+    return [
+        { 'chunkId': obj['chunkId'], 'faissIndex': int(obj['faissIndex']), 'text': obj['text'],  'pageNumber': obj['pageNumber'], 'order': obj['order'],
+          'duplicateOf': obj.get('duplicateOf') }
+        for obj in chunk_objs
+    ]
+
+async def process_document(docId: str, userId: str, fileUrl: str):
+    """
+    Download -> spool to a temp file -> extract page by page -> chunk ->
+    embed and append to the index every INGEST_BATCH_CHUNKS chunks. Only
+    the current batch of pages, chunks and embeddings is held in memory.
+    Progress is reported through get_ingest_progress(docId).
+
+    Raises Overloaded before any work when too many ingests are running;
+    once started, an ingest waits for the executors instead.
+    """
+    with admit('ingest'):
+        return await _process_document(docId, userId, fileUrl)
+
+async def _process_document(docId: str, userId: str, fileUrl: str):
+    _set_progress(docId, userId=userId, status='downloading', startedAt=time.time(), error=None,
+                  bytesDownloaded=0, bytesTotal=None, pages=0, chunks=0, duplicates=0)
+    fd, path = tempfile.mkstemp(suffix='.ingest', dir=INGEST_SPOOL_DIR)
+    os.close(fd)
+    pages = None
     result = []
-    for obj, fid in zip(chunk_objs, faiss_ids):
-        result.append({ 'chunkId': obj['chunkId'], 'faissIndex': int(fid), 'text': obj['text'],  'pageNumber': obj['pageNumber'], 'order': obj['order'] })
+    seen = {}
+    duplicates = 0
+    indexing = False
+    try:
+        # download file
+        await run_admitted('network', _spool, fileUrl, path, docId)
+        _set_progress(docId, status='indexing')
+
+        # extract, chunk, embed and index page by page
+        pages = iter_file_sections(path, fileUrl)
+        batch = []
+        while True:
+            item = await run_admitted('cpu', _next_page_chunks, pages)
+            if item is not None:
+                page_number, page_chunks = item
+                batch.extend(page_chunks)
+                _set_progress(docId, pages=page_number)
+            if batch and (item is None or len(batch) >= INGEST_BATCH_CHUNKS):
+                indexing = True
+                indexed = await _index_batch(docId, userId, batch, len(result), seen)
+                result.extend(indexed)
+                duplicates += sum(1 for c in indexed if c['duplicateOf'])
+                batch = []
+                _set_progress(docId, chunks=len(result), duplicates=duplicates)
+            if item is None:
+                break
 
-    return result
+        _set_progress(docId, status='done')
+        return result
+    except Exception as e:
+        _set_progress(docId, status='failed', error=str(e))
+        if indexing:
+            # Don't leave a partially indexed document behind
+            try:
+                await run_admitted('disk', delete_document_vectors, userId, docId)
+            except Exception as cleanup_error:
+                print(f"⚠ INGEST: could not roll back docId={docId}: {cleanup_error}")
+        raise
+    finally:
+        if pages is not None:
+            pages.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
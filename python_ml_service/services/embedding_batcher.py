@@ -0,0 +1,142 @@
+"""
+Dynamic batching of embedding requests.
+
+Callers submit a list of texts and get a Future. A background worker takes
+the first waiting request, keeps collecting requests for up to
+EMBED_MAX_WAIT_MS or until EMBED_MAX_BATCH texts are pending, and encodes
+them in one forward pass. Concurrent queries thus share a batch instead of
+each running a batch of one. Larger EMBED_MAX_WAIT_MS trades latency for
+throughput.
+
+A round never holds more than EMBED_MAX_BATCH texts. Larger requests (an
+ingest batch) are sorted by length and split into pieces of that size,
+which wait behind requests that fit in one piece. A query that arrives
+during an ingest thus waits for at most one batch, not the whole ingest,
+and the pieces hold texts of similar length, so little compute goes to
+padding.
+"""
+import os
+import time
+import queue
+import threading
+import itertools
+from concurrent.futures import Future
+import numpy as np
+
+BATCHING_ENABLED = os.environ.get('EMBED_BATCHING', '1') == '1'
+MAX_BATCH = int(os.environ.get('EMBED_MAX_BATCH', 64))
+MAX_WAIT_MS = float(os.environ.get('EMBED_MAX_WAIT_MS', 5))
+
+
+class _Request:
+    def __init__(self, n_texts: int, future: Future):
+        self.future = future
+        self.out = [None] * n_texts
+        self.remaining = n_texts
+
+
+class EmbeddingBatcher:
+    def __init__(self, encode, max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS):
+        """encode(texts, batch_size) -> (len(texts), dim) array."""
+        self._encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        # (lane, seq, texts, positions in the request, request): lane 0 for
+        # requests that fit in one round, 1 for pieces of larger ones
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.texts = 0
+        self.rounds = 0
+        self.batches = 0
+
+    def submit(self, texts) -> Future:
+        """Queue texts for encoding; the Future resolves to their (len(texts), dim) embeddings."""
+        texts = list(texts)
+        future = Future()
+        if not texts:
+            future.set_result(np.empty((0, 0), dtype='float32'))
+            return future
+        request = _Request(len(texts), future)
+        self._ensure_worker()
+        if len(texts) <= self.max_batch:
+            self._queue.put((0, next(self._seq), texts, range(len(texts)), request))
+            return future
+        # Character length stands in for token length, as in sentence-transformers itself
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), self.max_batch):
+            positions = order[start:start + self.max_batch]
+            self._queue.put((1, next(self._seq), [texts[i] for i in positions], positions, request))
+        return future
+
+    def _ensure_worker(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            n_texts = len(pending[0][2])
+            deadline = time.monotonic() + self.max_wait
+            while n_texts < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    piece = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if n_texts + len(piece[2]) > self.max_batch:
+                    # Keeps its place: the queue is ordered by (lane, seq)
+                    self._queue.put(piece)
+                    break
+                pending.append(piece)
+                n_texts += len(piece[2])
+            self._process(pending)
+
+    def _process(self, pending):
+        # Pieces of a request that already failed are dropped
+        pending = [piece for piece in pending if not piece[4].future.done()]
+        if not pending:
+            return
+        texts = [text for piece in pending for text in piece[2]]
+        try:
+            embs = self._encode(texts, len(texts))
+        except Exception as e:
+            for piece in pending:
+                if not piece[4].future.done():
+                    piece[4].future.set_exception(e)
+            return
+        finished = 0
+        offset = 0
+        for _, _, piece_texts, positions, request in pending:
+            for position, emb in zip(positions, embs[offset:offset + len(piece_texts)]):
+                request.out[position] = emb
+            offset += len(piece_texts)
+            request.remaining -= len(piece_texts)
+            if request.remaining == 0:
+                request.future.set_result(np.vstack(request.out))
+                finished += 1
+        with self._stats_lock:
+            self.requests += finished
+            self.texts += len(texts)
+            self.rounds += 1
+            self.batches += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'max_batch': self.max_batch,
+                'max_wait_ms': self.max_wait * 1000,
+                'requests': self.requests,
+                'texts': self.texts,
+                'rounds': self.rounds,
+                'batches': self.batches,
+                'requests_per_round': round(self.requests / self.rounds, 2) if self.rounds else 0.0,
+                'texts_per_batch': round(self.texts / self.batches, 2) if self.batches else 0.0,
+            }
@@ -0,0 +1,184 @@
+"""
+Content-addressed cache of text embeddings.
+
+Entries are keyed by sha1(model name + text), so a chunk or query that was
+embedded before - by any document or user - skips the model. Two tiers:
+
+- memory: LRU of recent vectors, bounded by EMBEDDING_CACHE_MAX_ITEMS
+- disk:   append-only store under EMBEDDING_CACHE_DIR/<model>/, shared by
+          worker processes and kept across restarts
+
+    keys.bin      20-byte sha1 digests, one per row
+    vectors.f32   float32 rows (dim from meta.json), memory-mapped for reads
+
+Rows are appended vectors first, keys second, so a key never points at a
+row that isn't fully written; a torn tail from a crash is ignored and cut
+off by the next append. The disk tier stops growing at EMBEDDING_CACHE_DISK_MAX_BYTES.
+"""
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_ENABLED = os.environ.get('EMBEDDING_CACHE', '1') == '1'
+CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', os.path.join(os.getcwd(), 'embedding_cache'))
+CACHE_MAX_ITEMS = int(os.environ.get('EMBEDDING_CACHE_MAX_ITEMS', 50000))
+CACHE_DISK_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_DISK_MAX_BYTES', 1024 * 1024 * 1024))
+
+KEY_BYTES = 20
+
+
+def text_key(model_name: str, text: str) -> bytes:
+    return hashlib.sha1(f'{model_name}\0{text}'.encode('utf8')).digest()
+
+
+class DiskTier:
+    """Append-only key -> vector rows on disk, re-read incrementally when other processes append."""
+
+    def __init__(self, root: str, model_name: str):
+        self.dir = os.path.join(root, model_name.replace('/', '_'))
+        self.keys_path = os.path.join(self.dir, 'keys.bin')
+        self.vectors_path = os.path.join(self.dir, 'vectors.f32')
+        self.meta_path = os.path.join(self.dir, 'meta.json')
+        self.dim = None
+        self._rows = {}  # key -> row
+        self._keys_read = 0  # bytes of keys.bin already indexed
+        self._vectors = None  # memmap over vectors.f32
+        self.full = False
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf8') as f:
+                self.dim = json.load(f)['dim']
+            self._refresh()
+
+    def get(self, key: bytes):
+        row = self._rows.get(key)
+        if row is None and self.dim is not None and os.path.exists(self.keys_path) \
+                and os.path.getsize(self.keys_path) > self._keys_read:
+            # Another process may have appended it
+            self._refresh()
+            row = self._rows.get(key)
+        if row is None:
+            return None
+        return np.array(self._vectors[row])
+
+    def put_many(self, keys, vectors: np.ndarray):
+        if self.full or not len(keys):
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            if not os.path.exists(self.meta_path):
+                tmp = self.meta_path + f'.tmp-{os.getpid()}'
+                with open(tmp, 'w', encoding='utf8') as f:
+                    json.dump({'dim': self.dim}, f)
+                os.replace(tmp, self.meta_path)
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        with open(os.path.join(self.dir, '.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            self._refresh()
+            fresh = [i for i, key in enumerate(keys) if key not in self._rows]
+            if not fresh:
+                return
+            # Rows past the last complete key were left by a crashed writer;
+            # cut both files back to the same row count so they stay aligned
+            row_bytes = self.dim * 4
+            n_rows = self._keys_read // KEY_BYTES
+            if n_rows * row_bytes + len(fresh) * row_bytes > CACHE_DISK_MAX_BYTES:
+                self.full = True
+                print(f"Embedding cache on disk is full ({n_rows} rows), no longer adding to it")
+                return
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(n_rows * row_bytes)
+                f.write(vectors[fresh].tobytes())
+            with open(self.keys_path, 'ab') as f:
+                f.truncate(n_rows * KEY_BYTES)
+                f.write(b''.join(keys[i] for i in fresh))
+            self._refresh()
+
+    def _refresh(self):
+        if not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+            return
+        n_rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        if n_rows == 0:
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self._keys_read)
+            tail = f.read()
+        tail = tail[:len(tail) - len(tail) % KEY_BYTES]
+        row = self._keys_read // KEY_BYTES
+        for offset in range(0, len(tail), KEY_BYTES):
+            if row >= n_rows:
+                break
+            self._rows[tail[offset:offset + KEY_BYTES]] = row
+            row += 1
+        self._keys_read = row * KEY_BYTES
+        if self._vectors is None or len(self._vectors) < n_rows:
+            self._vectors = np.memmap(self.vectors_path, dtype='float32', mode='r', shape=(n_rows, self.dim))
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class EmbeddingCache:
+    def __init__(self, model_name: str, root: str = CACHE_DIR, max_items: int = CACHE_MAX_ITEMS):
+        self.model_name = model_name
+        self.max_items = max_items
+        self._memory = OrderedDict()  # key -> vector
+        self._disk = DiskTier(root, model_name)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_many(self, texts):
+        """(keys, vectors) for texts; vectors[i] is None where texts[i] isn't cached."""
+        keys = [text_key(self.model_name, t) for t in texts]
+        found = []
+        with self._lock:
+            for key in keys:
+                vec = self._memory.get(key)
+                if vec is not None:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                else:
+                    vec = self._disk.get(key)
+                    if vec is not None:
+                        self.disk_hits += 1
+                        self._remember(key, vec)
+                    else:
+                        self.misses += 1
+                found.append(vec)
+        return keys, found
+
+    def put_many(self, keys, vectors: np.ndarray):
+        with self._lock:
+            for key, vec in zip(keys, vectors):
+                self._remember(key, np.array(vec, dtype='float32'))
+            self._disk.put_many(keys, vectors)
+
+    def _remember(self, key, vec):
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'model': self.model_name,
+                'memory_entries': len(self._memory),
+                'disk_entries': len(self._disk),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,109 @@
+"""
+Process pool for embedding large batches (document ingest, bulk reindexing).
+
+With EMBED_POOL_WORKERS > 0, embed_texts sends batches of at least
+EMBED_POOL_MIN_TEXTS uncached texts here instead of to the in-process
+batcher. Texts are sorted by length and cut into shards (several per
+worker, so a slow shard doesn't hold up the others). Each worker process
+loads its own model, limits torch to its share of the cores, and writes its
+normalized rows straight into a shared-memory output matrix, so results
+are never pickled back.
+"""
+import os
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+POOL_WORKERS = int(os.environ.get('EMBED_POOL_WORKERS', 0))  # 0: no pool
+POOL_MIN_TEXTS = int(os.environ.get('EMBED_POOL_MIN_TEXTS', 256))
+SHARDS_PER_WORKER = 4
+MIN_SHARD_TEXTS = 32
+WORKER_BATCH_SIZE = 32
+
+
+def _init_worker(threads: int):
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from services.embeddings import get_model
+    get_model()
+
+
+def _worker_dim() -> int:
+    from services.embeddings import _encode
+    return int(_encode(['dimension probe']).shape[1])
+
+
+def _worker_encode(shm_name: str, n_rows: int, dim: int, positions, texts) -> int:
+    from services.embeddings import _encode
+    embs = _encode(texts, batch_size=WORKER_BATCH_SIZE)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray((n_rows, dim), dtype='float32', buffer=shm.buf)
+        out[positions] = embs
+        del out
+    finally:
+        shm.close()
+    return len(texts)
+
+
+class EmbeddingPool:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+        self._dim = None
+        self._lock = threading.Lock()
+        # Callers get a Future; the shard fan-out / gather runs on these threads
+        self._runner = ThreadPoolExecutor(max_workers=2, thread_name_prefix='embedding-pool')
+
+    def submit(self, texts) -> Future:
+        return self._runner.submit(self.encode, list(texts))
+
+    def encode(self, texts) -> np.ndarray:
+        """(len(texts), dim) normalized embeddings, computed across the worker processes."""
+        executor = self._ensure_started()
+        n = len(texts)
+        order = sorted(range(n), key=lambda i: len(texts[i]))
+        shard = max(MIN_SHARD_TEXTS, -(-n // (self.workers * SHARDS_PER_WORKER)))
+        shm = shared_memory.SharedMemory(create=True, size=max(1, n * self._dim * 4))
+        futures = []
+        try:
+            for start in range(0, n, shard):
+                positions = order[start:start + shard]
+                futures.append(executor.submit(
+                    _worker_encode, shm.name, n, self._dim, positions, [texts[i] for i in positions]))
+            for future in futures:
+                future.result()
+            return np.ndarray((n, self._dim), dtype='float32', buffer=shm.buf).copy()
+        finally:
+            for future in futures:
+                future.cancel()
+            shm.close()
+            shm.unlink()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process that already holds torch threads can deadlock
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(threads,),
+                )
+                self._dim = self._executor.submit(_worker_dim).result()
+                print(f"Started embedding pool: {self.workers} workers x {threads} threads")
+            return self._executor
+
+
+_pool = EmbeddingPool(POOL_WORKERS) if POOL_WORKERS > 0 else None
+
+
+def get_pool():
+    """The shared pool, or None when EMBED_POOL_WORKERS is 0."""
+    return _pool
@@ -1,23 +1,132 @@
+import os
+import asyncio
+import threading
 import importlib
+from concurrent.futures import Future
 import numpy as np
 
+from services.embedding_batcher import BATCHING_ENABLED, EmbeddingBatcher
+from services.embedding_cache import CACHE_ENABLED, EmbeddingCache
+from services.embedding_pool import POOL_MIN_TEXTS, get_pool
+from services.executors import reserve
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+MAX_SEQ_LENGTH = 256  # tokens the model embeds, [CLS] and [SEP] included; the rest is truncated
+# 'torch' (sentence-transformers) or 'onnx' (int8 ONNX Runtime, see services/onnx_embedder.py)
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch')
+
+# Quantized vectors differ slightly from the PyTorch ones, so each backend has its own cache entries
+CACHE_MODEL_NAME = MODEL_NAME if EMBEDDING_BACKEND == 'torch' else f'{MODEL_NAME}-onnx-int8'
+
 _model = None
+_cache = EmbeddingCache(CACHE_MODEL_NAME) if CACHE_ENABLED else None
 
 def get_model():
     global _model
-    if _model is None:
+    if _model is None and EMBEDDING_BACKEND == 'onnx':
+        from services.onnx_embedder import OnnxEmbedder
+        _model = OnnxEmbedder(MODEL_NAME)
+    elif _model is None:
         try:
             SentenceTransformer = importlib.import_module('sentence_transformers').SentenceTransformer
         except Exception as e:
             raise ImportError('sentence-transformers is required for embeddings. Install it into the service venv: pip install sentence-transformers') from e
-        _model = SentenceTransformer('all-MiniLM-L6-v2')
+        _model = SentenceTransformer(MODEL_NAME)
     return _model
 
-def embed_texts(texts):
-    """Embed texts using local sentence-transformers and return normalized numpy embeddings."""
+_tokenizers = threading.local()
+
+def get_tokenizer():
+    """
+    The model's tokenizer, one instance per thread: a fast tokenizer shared
+    across threads fails when another caller changes its truncation settings.
+    """
+    tokenizer = getattr(_tokenizers, 'tokenizer', None)
+    if tokenizer is None:
+        try:
+            transformers = importlib.import_module('transformers')
+        except Exception as e:
+            raise ImportError('transformers is required for the tokenizer. Install it into the service venv: pip install transformers') from e
+        hf_name = MODEL_NAME if '/' in MODEL_NAME else f'sentence-transformers/{MODEL_NAME}'
+        tokenizer = _tokenizers.tokenizer = transformers.AutoTokenizer.from_pretrained(hf_name)
+    return tokenizer
+
+def _encode(texts, batch_size=32):
     model = get_model()
-    embs = model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+    embs = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
     norms = np.linalg.norm(embs, axis=1, keepdims=True)
     norms[norms==0] = 1.0
     embs = embs / norms
     return embs
+
+_batcher = EmbeddingBatcher(_encode) if BATCHING_ENABLED else None
+
+def _encode_future(texts) -> Future:
+    """
+    Encode texts on the process pool when there are enough of them, else
+    through the dynamic batcher (or right away when batching is off).
+    """
+    pool = get_pool()
+    if pool is not None and len(texts) >= POOL_MIN_TEXTS:
+        return pool.submit(texts)
+    if _batcher is not None:
+        return _batcher.submit(texts)
+    future = Future()
+    future.set_result(_encode(texts))
+    return future
+
+def _lookup(texts):
+    """Cached vectors for texts (None where missing) and the distinct texts still to encode."""
+    if _cache is None:
+        return [None] * len(texts), list(dict.fromkeys(texts)), None
+    keys, found = _cache.get_many(texts)
+    missing = list(dict.fromkeys(t for t, vec in zip(texts, found) if vec is None))
+    return found, missing, dict(zip(texts, keys))
+
+def _merge(texts, found, missing, encoded, key_of):
+    if missing:
+        if _cache is not None:
+            _cache.put_many([key_of[t] for t in missing], encoded)
+        by_text = dict(zip(missing, encoded))
+        found = [vec if vec is not None else by_text[t] for t, vec in zip(texts, found)]
+    return np.vstack(found).astype('float32', copy=False)
+
+def embed_texts(texts):
+    """
+    Embed texts using local sentence-transformers and return normalized numpy embeddings.
+    Texts seen before (same model) come from the embedding cache; only the
+    distinct uncached ones are encoded, batched together with concurrent callers.
+    """
+    texts = list(texts)
+    if not texts:
+        return _encode(texts)
+    found, missing, key_of = _lookup(texts)
+    encoded = _encode_future(missing).result() if missing else None
+    return _merge(texts, found, missing, encoded, key_of)
+
+async def embed_texts_async(texts, admitted: bool = False):
+    """
+    embed_texts for async handlers: waits for the batcher without blocking
+    the event loop. Cache misses count against the cpu executor's cap while
+    they are encoded (admitted: the caller is an admitted job, so wait
+    rather than raise Overloaded).
+    """
+    texts = list(texts)
+    if not texts:
+        return _encode(texts)
+    found, missing, key_of = _lookup(texts)
+    encoded = None
+    if missing:
+        with reserve('cpu', admitted):
+            encoded = await asyncio.wrap_future(_encode_future(missing))
+    return _merge(texts, found, missing, encoded, key_of)
+
+def get_embedding_cache_stats() -> dict:
+    if _cache is None:
+        return { 'enabled': False }
+    return { 'enabled': True, **_cache.stats() }
+
+def get_embedding_batcher_stats() -> dict:
+    if _batcher is None:
+        return { 'enabled': False }
+    return { 'enabled': True, **_batcher.stats() }
@@ -0,0 +1,217 @@
+"""
+Bounded executors for the blocking work behind the async endpoints.
+
+Each workload class has its own thread pool, so one kind of slow work can't
+take the threads (or the event loop) another kind needs:
+
+    cpu      embedding lookups, FAISS search, text emotion, parsing
+    audio    ffmpeg + Whisper + speech emotion (long-running)
+    network  OpenAI, MongoDB, file downloads, peer calls
+    disk     index writes (ingest, delete, compaction, reindex)
+
+Every class also caps how many calls may be queued or running. Beyond
+that, run() raises Overloaded (HTTP 429 with Retry-After) immediately
+instead of letting requests pile up. Sizes come from
+EXEC_<CLASS>_WORKERS and EXEC_<CLASS>_QUEUE.
+
+Long jobs made of many calls (document ingest) are limited once, when
+they start: admit() raises Overloaded when EXEC_<JOB>_ACTIVE of them are
+already running. An admitted job then uses run_admitted(), which queues
+past the cap instead of raising, so minutes of work aren't failed (and
+rolled back) halfway. Its calls still count as pending, so new requests
+see the load.
+
+reserve() counts work done outside the pools (the embedding batcher and
+process pool) against a class's cap while the caller waits for it.
+
+The heavy native code (torch, FAISS, onnxruntime) releases the GIL, so
+threads give real parallelism. Bulk embedding has its own process pool
+(services/embedding_pool.py).
+
+run_iter() does the same for a blocking generator (streamed LLM answers),
+handing its items to the event loop as they come.
+"""
+import os
+import asyncio
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+
+_CPUS = os.cpu_count() or 1
+
+# workload -> (default workers, default max queued + running)
+_DEFAULTS = {
+    'cpu': (_CPUS, _CPUS * 8),
+    'audio': (max(1, _CPUS // 4), 8),
+    'network': (32, 256),
+    'disk': (4, 64),
+}
+
+# job -> default max running at once
+_JOB_DEFAULTS = {
+    'ingest': max(2, _CPUS),
+}
+
+
+class Overloaded(HTTPException):
+    def __init__(self, workload: str, retry_after: int = 1):
+        super().__init__(
+            status_code=429,
+            detail=f'Server busy ({workload} queue full), retry later',
+            headers={'Retry-After': str(retry_after)},
+        )
+
+
+class BoundedExecutor:
+    def __init__(self, name: str, workers: int, max_pending: int):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'exec-{name}')
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @contextmanager
+    def reserve(self, admitted: bool = False):
+        """Count one call as pending for the block; raises Overloaded when full unless admitted."""
+        with self._lock:
+            if self.pending >= self.max_pending and not admitted:
+                self.rejected += 1
+                raise Overloaded(self.name)
+            self.pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    async def run(self, call, admitted: bool = False):
+        with self.reserve(admitted):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, call)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+
+class JobLimit:
+    def __init__(self, name: str, max_active: int):
+        self.name = name
+        self.max_active = max_active
+        self._lock = threading.Lock()
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @contextmanager
+    def admit(self):
+        with self._lock:
+            if self.active >= self.max_active:
+                self.rejected += 1
+                raise Overloaded(self.name, retry_after=5)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_active': self.max_active,
+                'active': self.active,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+
+_executors = {
+    name: BoundedExecutor(
+        name,
+        int(os.environ.get(f'EXEC_{name.upper()}_WORKERS', workers)),
+        int(os.environ.get(f'EXEC_{name.upper()}_QUEUE', max_pending)),
+    )
+    for name, (workers, max_pending) in _DEFAULTS.items()
+}
+
+_jobs = {
+    name: JobLimit(name, int(os.environ.get(f'EXEC_{name.upper()}_ACTIVE', max_active)))
+    for name, max_active in _JOB_DEFAULTS.items()
+}
+
+
+async def run(workload: str, fn, *args, **kwargs):
+    """Run blocking fn(*args, **kwargs) on the workload's pool; raises Overloaded when its queue is full."""
+    return await _executors[workload].run(functools.partial(fn, *args, **kwargs))
+
+
+async def run_admitted(workload: str, fn, *args, **kwargs):
+    """run() for a job already let in by admit(): waits for the pool instead of raising Overloaded."""
+    return await _executors[workload].run(functools.partial(fn, *args, **kwargs), admitted=True)
+
+
+def reserve(workload: str, admitted: bool = False):
+    """Context manager counting work done outside the pools against the workload's cap."""
+    return _executors[workload].reserve(admitted)
+
+
+def admit(job: str):
+    """Context manager holding one of the job's slots; raises Overloaded when all are taken."""
+    return _jobs[job].admit()
+
+
+async def run_iter(workload: str, gen):
+    """
+    Iterate the blocking generator gen on one of the workload's threads,
+    yielding its items as they are produced. The thread counts against the
+    pool until gen is exhausted or the caller stops iterating; errors from
+    gen (or Overloaded) are raised here.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def pump():
+        try:
+            for item in gen:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(items.put_nowait, item)
+        finally:
+            gen.close()
+
+    task = asyncio.ensure_future(run(workload, pump))
+    # Queued after every item pump put, since the task finishes after them
+    task.add_done_callback(lambda _: items.put_nowait(done))
+    try:
+        while True:
+            item = await items.get()
+            if item is done:
+                break
+            yield item
+        await task
+    finally:
+        stop.set()
+        # The caller stopped early: don't report pump's result as never retrieved
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+def executor_stats() -> dict:
+    stats = { name: ex.stats() for name, ex in _executors.items() }
+    stats['jobs'] = { name: job.stats() for name, job in _jobs.items() }
+    return stats
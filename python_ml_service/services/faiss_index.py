@@ -1,16 +1,119 @@
 import os
 import json
+import uuid
+import shutil
+import threading
 import numpy as np
 import faiss
 from typing import List
 
+from services.index_cache import IndexCache
+from services.index_factory import EXACT_KIND, RESCORE_FACTOR, TRAINED_KINDS, UserIndex, build_index, choose_kind, gather_vectors, new_index, rescore
+from services.meta_store import MetaStore, open_segment_meta, write_meta
+from services.user_lock import UserLock
+from services import answer_cache, shard_router
+
 BASE = os.path.join(os.getcwd(), 'indexes')
 os.makedirs(BASE, exist_ok=True)
 
-def _user_paths(userId: str):
-    d = os.path.join(BASE, userId)
+# Delta segments are folded into a new base once there are this many of them,
+# or once they hold this fraction of the base's vectors
+COMPACT_MAX_SEGMENTS = int(os.environ.get('FAISS_COMPACT_MAX_SEGMENTS', 16))
+COMPACT_SEGMENT_RATIO = float(os.environ.get('FAISS_COMPACT_SEGMENT_RATIO', 0.5))
+# ...or once deleted (tombstoned) vectors reach this fraction of the live ones
+COMPACT_TOMBSTONE_RATIO = float(os.environ.get('FAISS_COMPACT_TOMBSTONE_RATIO', 0.25))
+
+# Resident indexes, shared by all requests in this process
+_index_cache = IndexCache()
+# In-process write counter per user, bumped on every add/delete/compaction
+_generations = {}
+
+# Per-user reader/writer locks, shared with other worker processes through
+# lock files: cold loads read; ingest, delete and compaction commits write
+_user_locks = {}
+_user_locks_guard = threading.Lock()
+_compacting = set()
+# One compaction at a time per user (across processes too): a finished
+# compaction garbage-collects every base the manifest doesn't reference,
+# including one still being written
+_compact_locks = {}
+
+# On-disk layout of indexes/<userId>/ (indexes/shard-<k>/<userId>/ when
+# sharded, see services/shard_router.py):
+#   manifest.json          commit point: base, ordered list of delta segments,
+#                          tombstoned (deleted) id ranges and the docId -> id
+#                          ranges index
+#   segments/base-<id>/    compacted base: index.faiss, vectors.npy, ids.npy + metadata columns
+#   segments/seg-<seq>/    delta from one ingest: vectors.npy, ids.npy + metadata columns
+#   index.faiss, meta.json, vectors.npy
+#                          pre-segment store, read as the base until first compaction
+#   .lock, .compact.lock   flock targets for the store lock and compaction
+#
+# vectors.npy is a contiguous float32 (N, dim) matrix and ids.npy the parallel
+# int64 id array, both sorted by id and opened memory-mapped. Stores written
+# before that hold a pickled {id: vector} dict in vectors.npy and no ids.npy.
+# Metadata columns are described in services/meta_store.py; older segments
+# have a meta.json instead (see migrate_meta_store.py).
+
+def _user_path(userId: str):
+    if shard_router.NUM_SHARDS == 1:
+        return os.path.join(BASE, userId)
+    return os.path.join(BASE, f'shard-{shard_router.shard_for(userId)}', userId)
+
+def _user_dir(userId: str):
+    d = _user_path(userId)
+    if not os.path.isdir(d):
+        _relocate_user(userId, d)
     os.makedirs(d, exist_ok=True)
-    return d, os.path.join(d, 'index.faiss'), os.path.join(d, 'meta.json'), os.path.join(d, 'vectors.npy')
+    return d
+
+def _relocate_user(userId: str, d: str):
+    """
+    Move a user's store to d if it sits where an earlier shard count put it
+    (indexes/<userId> unsharded, or another shard-<k>). With consistent
+    hashing only about 1/N of the users move when N changes.
+    """
+    candidates = [os.path.join(BASE, userId)]
+    candidates += [os.path.join(BASE, name, userId) for name in os.listdir(BASE) if name.startswith('shard-')]
+    for old in candidates:
+        if old != d and os.path.isdir(old) and not old.startswith(d + os.sep):
+            os.makedirs(os.path.dirname(d), exist_ok=True)
+            try:
+                os.rename(old, d)
+                print(f"Moved store of userId={userId} to {os.path.relpath(d, BASE)}")
+            except OSError:
+                pass  # another worker moved it first
+            return
+
+def list_user_ids(shards=None) -> List[str]:
+    """userIds with a store on this node, optionally only those on the given shards."""
+    users = []
+    for name in sorted(os.listdir(BASE)):
+        path = os.path.join(BASE, name)
+        if not os.path.isdir(path):
+            continue
+        if name.startswith('shard-'):
+            if shards is None or int(name[len('shard-'):]) in shards:
+                users += sorted(u for u in os.listdir(path) if os.path.isdir(os.path.join(path, u)))
+        elif shards is None or shard_router.shard_for(name) in shards:
+            users.append(name)
+    return users
+
+def _legacy_paths(d):
+    return os.path.join(d, 'index.faiss'), os.path.join(d, 'meta.json'), os.path.join(d, 'vectors.npy')
+
+def _segment_dir(d, name):
+    return os.path.join(d, 'segments', name)
+
+def _base_dir(d, manifest):
+    return d if manifest['base'] is None else _segment_dir(d, manifest['base'])
+
+def _base_paths(d, manifest):
+    b = _base_dir(d, manifest)
+    return os.path.join(b, 'index.faiss'), os.path.join(b, 'meta.json'), os.path.join(b, 'vectors.npy')
+
+def _manifest_path(d):
+    return os.path.join(d, 'manifest.json')
 
 def _load_meta(meta_path):
     if os.path.exists(meta_path):
@@ -18,243 +121,742 @@ def _load_meta(meta_path):
             return json.load(f)
     return { 'next_id': 1, 'items': {} }
 
-def _save_meta(meta_path, meta):
-    with open(meta_path, 'w', encoding='utf8') as f:
-        json.dump(meta, f)
+def _load_manifest(d):
+    path = _manifest_path(d)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf8') as f:
+            manifest = json.load(f)
+        manifest.setdefault('tombstones', [])
+        manifest.setdefault('tombstone_rows', 0)
+        manifest.setdefault('shared', {})
+        if 'docs' not in manifest:
+            # Written before the doc index existed: derive it once from the metadata
+            store = _open_meta_store(d, manifest)
+            manifest['docs'] = _doc_ranges(store.rows(), _range_ids(manifest['tombstones']))
+        return manifest
+    # No manifest yet: an existing pre-segment store becomes the base
+    legacy_meta = _load_meta(_legacy_paths(d)[1])
+    return {
+        'version': 1,
+        'generation': 0,
+        'next_id': legacy_meta['next_id'],
+        'base': None,
+        'base_rows': len(legacy_meta['items']),
+        'segments': [],
+        'tombstones': [],
+        'tombstone_rows': 0,
+        'shared': {},
+        'docs': _doc_ranges((int(eid), item) for eid, item in legacy_meta['items'].items()),
+        'next_seq': 1,
+    }
+
+def _save_manifest(d, manifest):
+    """Atomically replace the manifest; a write only becomes visible once this returns."""
+    path = _manifest_path(d)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf8') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(d)
+
+def _fsync_dir(path):
+    """Persist a directory's entries (renames into it), where the platform allows."""
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _tmp_segment_dir(d):
+    """Fresh directory to write a segment into before it is renamed into place."""
+    tmp = _segment_dir(d, f".tmp-{uuid.uuid4().hex[:12]}")
+    os.makedirs(tmp)
+    return tmp
+
+def _publish_segment(d, tmp, name):
+    """
+    Flush a fully written segment to disk and rename it to its final name, so
+    a segment dir is either complete or absent. Only then may the manifest
+    point at it.
+    """
+    for entry in os.listdir(tmp):
+        fd = os.open(os.path.join(tmp, entry), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    seg = _segment_dir(d, name)
+    if os.path.exists(seg):
+        # Left behind by a crash before its manifest commit, so unreferenced
+        shutil.rmtree(seg)
+    os.replace(tmp, seg)
+    _fsync_dir(os.path.dirname(seg))
+    return seg
+
+def _id_ranges(ids):
+    """Collapse sorted ids into [start, end) ranges (a document's ids are contiguous per ingest)."""
+    ranges = []
+    for eid in ids:
+        eid = int(eid)
+        if ranges and ranges[-1][1] == eid:
+            ranges[-1][1] = eid + 1
+        else:
+            ranges.append([eid, eid + 1])
+    return ranges
+
+def _range_ids(ranges):
+    if not ranges:
+        return np.empty(0, dtype='int64')
+    return np.concatenate([np.arange(start, end, dtype='int64') for start, end in ranges])
+
+def _doc_ranges(rows, dead=()):
+    """docId -> sorted [start, end) id ranges, built from a full scan of (id, item) rows."""
+    dead = set(int(eid) for eid in dead)
+    docs = {}
+    for eid, item in rows:
+        if eid not in dead:
+            docs.setdefault(str(item.get('docId')), []).append(eid)
+    return { docId: _id_ranges(sorted(ids)) for docId, ids in docs.items() }
+
+def _write_segment(d, name, ids, vectors, chunk_ids, doc_ids, orders):
+    tmp = _tmp_segment_dir(d)
+    np.save(os.path.join(tmp, 'vectors.npy'), vectors)
+    np.save(os.path.join(tmp, 'ids.npy'), ids)
+    write_meta(tmp, chunk_ids, doc_ids, orders)
+    return _publish_segment(d, tmp, name)
+
+def _read_vectors(vectors_path, ids_path):
+    """(ids, vectors) of one segment, memory-mapped; empty arrays if it has none."""
+    if os.path.exists(ids_path):
+        return np.load(ids_path, mmap_mode='r'), np.load(vectors_path, mmap_mode='r')
+    if not os.path.exists(vectors_path):
+        return np.empty(0, dtype='int64'), None
+    # Pickled {id: vector} dict from before the contiguous format
+    stored_vectors = np.load(vectors_path, allow_pickle=True).item()
+    if not stored_vectors:
+        return np.empty(0, dtype='int64'), None
+    ids = np.array(sorted(stored_vectors), dtype='int64')
+    return ids, np.vstack([stored_vectors[int(eid)] for eid in ids]).astype('float32')
 
-def _ensure_index(index_path, dim=384):
-    if os.path.exists(index_path):
-        index = faiss.read_index(index_path)
-    else:
-        index_flat = faiss.IndexFlatIP(dim)
-        index = faiss.IndexIDMap(index_flat)
-        faiss.write_index(index, index_path)
-    return index
+def _read_segment(d, name):
+    seg = _segment_dir(d, name)
+    return _read_vectors(os.path.join(seg, 'vectors.npy'), os.path.join(seg, 'ids.npy'))
 
-def add_chunks_to_index(userId: str, docId: str, chunk_objs: List[dict], embeddings: np.ndarray) -> List[int]:
+def _open_meta_store(d, manifest):
+    """Metadata of the base plus every delta segment (tombstoned rows included)."""
+    store = MetaStore()
+    store.add(open_segment_meta(_base_dir(d, manifest), _base_paths(d, manifest)[1]))
+    for seg in manifest['segments']:
+        store.add(open_segment_meta(_segment_dir(d, seg['name'])))
+    return store
+
+def _load_vectors(d, manifest):
+    """Every stored vector as a list of (ids, vectors) parts in ascending id order."""
+    vectors_path = _base_paths(d, manifest)[2]
+    ids_path = os.path.join(os.path.dirname(vectors_path), 'ids.npy') if manifest['base'] else ''
+    parts = [_read_vectors(vectors_path, ids_path)]
+    for seg in manifest['segments']:
+        parts.append(_read_segment(d, seg['name']))
+    return [(ids, vectors) for ids, vectors in parts if len(ids)]
+
+def _load_store(d, manifest):
+    """Rebuild the searchable (index, meta) pair from the base plus every delta segment."""
+    index_path = _base_paths(d, manifest)[0]
+    index = UserIndex(faiss.read_index(index_path)) if os.path.exists(index_path) else None
+    parts = [_read_segment(d, seg['name']) for seg in manifest['segments']]
+    parts = [(ids, vectors) for ids, vectors in parts if len(ids)]
+    if index is None and parts:
+        index = UserIndex(new_index(EXACT_KIND, parts[0][1].shape[1]))
+        if not index.index.is_trained:
+            # No base yet (sq8): train on every segment, not just the first
+            index.train(parts)
+    for ids, vectors in parts:
+        index.add(vectors, ids)
+    if index is None:
+        return None, None
+    dead = _range_ids(manifest['tombstones'])
+    if len(dead):
+        index.remove(dead)
+    # Tombstoned ids are gone from the index, so the store is only ever asked about live ones
+    meta = { 'next_id': manifest['next_id'], 'store': _open_meta_store(d, manifest), 'docs': manifest['docs'],
+             'shared': manifest['shared'] }
+    if RESCORE_FACTOR > 1:
+        # Memory-mapped float32 rows for exact re-ranking
+        meta['vectors'] = _load_vectors(d, manifest)
+    return index, meta
+
+def _write_base(d, parts, store):
+    """
+    Write a new base segment from (ids, vectors) parts, taking each row's
+    metadata from store. Rows are streamed into memory-mapped output files
+    part by part, so the vectors are never materialised as one in-memory
+    copy. The index type is picked by size (see index_factory). Returns
+    (name, index type).
+    """
+    name = f"base-{uuid.uuid4().hex[:12]}"
+    base = _tmp_segment_dir(d)
+    total = sum(len(ids) for ids, _ in parts)
+    chunk_ids, doc_ids, orders = [], [], []
+    kind = choose_kind(total)
+    if total:
+        dim = parts[0][1].shape[1]
+        ids_out = np.lib.format.open_memmap(os.path.join(base, 'ids.npy'), mode='w+', dtype='int64', shape=(total,))
+        vectors_out = np.lib.format.open_memmap(os.path.join(base, 'vectors.npy'), mode='w+', dtype='float32', shape=(total, dim))
+        pos = 0
+        for ids, vectors in parts:
+            ids_out[pos:pos + len(ids)] = ids
+            vectors_out[pos:pos + len(ids)] = vectors
+            pos += len(ids)
+            for eid in ids:
+                item = store.get(eid)
+                chunk_ids.append(item['chunkId'])
+                doc_ids.append(item['docId'])
+                orders.append(item.get('order', 0))
+        ids_out.flush()
+        vectors_out.flush()
+        index = build_index(kind, [(ids_out, vectors_out)], dim)
+        faiss.write_index(index, os.path.join(base, 'index.faiss'))
+        del ids_out, vectors_out
+        write_meta(base, chunk_ids, doc_ids, orders)
+    _publish_segment(d, base, name)
+    return name, kind
+
+def _remove_unreferenced(d, manifest):
+    """
+    Drop segment dirs (and pre-segment files) the manifest no longer points
+    to, including temp dirs of writes that crashed. Needs the write lock and
+    the compaction lock, so that no segment or base is mid-write.
+    """
+    live = { seg['name'] for seg in manifest['segments'] }
+    live.add(manifest['base'])
+    seg_root = os.path.join(d, 'segments')
+    if os.path.isdir(seg_root):
+        for name in os.listdir(seg_root):
+            if name not in live:
+                shutil.rmtree(os.path.join(seg_root, name), ignore_errors=True)
+    if manifest['base'] is not None:
+        for path in _legacy_paths(d):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _user_lock(userId: str) -> UserLock:
+    with _user_locks_guard:
+        if userId not in _user_locks:
+            _user_locks[userId] = UserLock(os.path.join(_user_path(userId), '.lock'))
+        return _user_locks[userId]
+
+def _compact_lock(userId: str) -> UserLock:
+    with _user_locks_guard:
+        if userId not in _compact_locks:
+            _compact_locks[userId] = UserLock(os.path.join(_user_path(userId), '.compact.lock'))
+        return _compact_locks[userId]
+
+def _bump_generation(userId: str):
+    _generations[userId] = _generations.get(userId, 0) + 1
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _cache_stamp(userId, d):
+    # The manifest mtime catches writes from other worker processes, the
+    # generation catches back-to-back writes in this one
+    return (_generations.get(userId, 0), _file_stamp(_manifest_path(d)), _file_stamp(_legacy_paths(d)[0]))
+
+def _cache_put(userId, stamp, index, meta):
+    # Metadata is memory-mapped, so the resident cost is the index itself
+    nbytes = index.nbytes()
+    _index_cache.put(userId, stamp, (index, meta), nbytes)
+
+def _load_user_index(userId: str):
+    """Return (index, meta) for a user, from the resident cache when still current."""
+    d = _user_dir(userId)
+    stamp = _cache_stamp(userId, d)
+    cached = _index_cache.get(userId, stamp)
+    if cached is not None:
+        return cached
+    # Cold load: hold the read lock so compaction can't remove segments mid-read
+    with _user_lock(userId).read():
+        stamp = _cache_stamp(userId, d)
+        index, meta = _load_store(d, _load_manifest(d))
+    if index is None:
+        return None, None
+    _cache_put(userId, stamp, index, meta)
+    return index, meta
+
+def get_index_cache_stats() -> dict:
+    return _index_cache.stats()
+
+def preload_owned_users():
+    """Load the users of this node's shards into the resident cache, until its budget is used."""
+    loaded = 0
+    for userId in list_user_ids(shard_router.OWNED_SHARDS):
+        stats = _index_cache.stats()
+        if stats['bytes'] >= stats['max_bytes']:
+            break
+        try:
+            index, _ = _load_user_index(userId)
+            loaded += index is not None
+        except Exception as e:
+            print(f"Preload failed for userId={userId}: {e}")
+    print(f"Preloaded {loaded} user indexes for shards {sorted(shard_router.OWNED_SHARDS)}")
+    return loaded
+
+def migrate_user_meta(userId: str) -> bool:
+    """Rewrite a user's store if any of its metadata is still JSON. Returns True if it was migrated."""
+    d = _user_path(userId)
+    if not os.path.isdir(d):
+        return False
+    with _user_lock(userId).read():
+        manifest = _load_manifest(d)
+        store = _open_meta_store(d, manifest)
+        if not store.needs_migration():
+            return False
+    return compact_user_index(userId, force=True)
+
+def _needs_compaction(manifest):
+    segment_rows = sum(seg['rows'] for seg in manifest['segments'])
+    live_rows = manifest['base_rows'] + segment_rows - manifest['tombstone_rows']
+    if manifest['tombstone_rows'] > COMPACT_TOMBSTONE_RATIO * max(live_rows, 1):
+        return True
+    if not manifest['segments']:
+        return False
+    return (len(manifest['segments']) >= COMPACT_MAX_SEGMENTS
+            or segment_rows > COMPACT_SEGMENT_RATIO * manifest['base_rows'])
+
+def _schedule_compaction(userId: str):
+    with _user_locks_guard:
+        if userId in _compacting:
+            return
+        _compacting.add(userId)
+
+    def run():
+        try:
+            compact_user_index(userId)
+        except Exception as e:
+            print(f"Compaction failed for userId={userId}: {e}")
+        finally:
+            with _user_locks_guard:
+                _compacting.discard(userId)
+
+    threading.Thread(target=run, name=f'faiss-compact-{userId}', daemon=True).start()
+
+def compact_user_index(userId: str, force: bool = False) -> bool:
+    """
+    Fold the current delta segments into a new base segment, dropping
+    tombstoned rows. Ids are kept as they are: chunks are resolved by
+    chunkId, so renumbering would only invalidate ids held by readers.
+
+    The new base is written while ingest and deletes continue; the manifest
+    swap at the end is atomic, so a crash at any point leaves either the old
+    or the new store fully readable. Returns False if there was nothing to do
+    or a concurrent writer replaced the base first. force rewrites the base
+    even when there is nothing to fold (used to migrate old formats).
+    """
+    _user_dir(userId)
+    with _compact_lock(userId).write():
+        return _compact(userId, force)
+
+def _compact(userId: str, force: bool) -> bool:
+    d = _user_dir(userId)
+    lock = _user_lock(userId)
+    with lock.write():
+        manifest = _load_manifest(d)
+        folded = [seg['name'] for seg in manifest['segments']]
+        folded_tombstones = list(manifest['tombstones'])
+        if not folded and not folded_tombstones and not force:
+            return False
+        base_before = manifest['base']
+        store = _open_meta_store(d, manifest)
+        dead = _range_ids(folded_tombstones)
+        parts = []
+        for ids, vectors in _load_vectors(d, manifest):
+            keep = ~np.isin(ids, dead)
+            if not keep.all():
+                ids, vectors = ids[keep], vectors[keep]
+            if len(ids):
+                parts.append((ids, vectors))
+
+    name, kind = _write_base(d, parts, store)
+    total = sum(len(ids) for ids, _ in parts)
+    del parts
+
+    with lock.write():
+        current = _load_manifest(d)
+        current_names = [seg['name'] for seg in current['segments']]
+        if (current['base'] != base_before
+                or current_names[:len(folded)] != folded
+                or current['tombstones'][:len(folded_tombstones)] != folded_tombstones):
+            shutil.rmtree(_segment_dir(d, name), ignore_errors=True)
+            return False
+        old_stamp = _cache_stamp(userId, d)
+        current['base'] = name
+        current['base_rows'] = total
+        current['index_type'] = kind
+        current['segments'] = current['segments'][len(folded):]
+        # Deletes that landed while the base was being written stay tombstoned
+        current['tombstones'] = current['tombstones'][len(folded_tombstones):]
+        current['tombstone_rows'] -= len(dead)
+        current['generation'] += 1
+        _save_manifest(d, current)
+        _bump_generation(userId)
+        _remove_unreferenced(d, current)
+        # Same live vectors, new layout: keep the resident index under the new
+        # stamp (with metadata reopened on the new files), unless the base was
+        # promoted to another index type or retrained, or the index still holds
+        # removed vectors (hnsw) that only the new base drops; the next query loads it
+        cached = _index_cache.peek(userId, old_stamp)
+        if cached is not None and cached[0].kind == kind and kind not in TRAINED_KINDS and not cached[0].dead:
+            index, meta = cached
+            store = _open_meta_store(d, current)
+            vectors = _load_vectors(d, current) if 'vectors' in meta else None
+            with index.lock.write():
+                meta['store'] = store
+                if vectors is not None:
+                    meta['vectors'] = vectors
+            _cache_put(userId, _cache_stamp(userId, d), index, meta)
+        else:
+            _index_cache.invalidate(userId)
+    print(f"Compacted {len(folded)} segments and {len(dead)} tombstones for userId={userId} ({total} vectors, {kind})")
+    return True
+
+def add_chunks_to_index(userId: str, docId: str, chunk_objs: List[dict], embeddings: np.ndarray, route: bool = True) -> List[int]:
+    """
+    Append chunks as a new delta segment. Cost is proportional to this
+    document only; compaction into the base runs in the background.
+    """
+    if not chunk_objs:
+        return []
+    peer = shard_router.peer_for(userId) if route else None
+    if peer:
+        ids = shard_router.forward(peer, 'add', {
+            'userId': userId, 'docId': docId, 'chunk_objs': chunk_objs,
+            'embeddings': np.asarray(embeddings[:len(chunk_objs)], dtype='float32').tolist(),
+        })
+        answer_cache.invalidate(userId)
+        return ids
+    d = _user_dir(userId)
     # embeddings shape (N, dim)
-    d, index_path, meta_path, vectors_path = _user_paths(userId)
-    dim = embeddings.shape[1]
-    index = _ensure_index(index_path, dim=dim)
-
-    # Load existing vectors store
-    if os.path.exists(vectors_path):
-        stored_vectors = np.load(vectors_path, allow_pickle=True).item()
-    else:
-        stored_vectors = {}
-
-    meta = _load_meta(meta_path)
-    ids = []
-    vectors = []
-    for i, obj in enumerate(chunk_objs):
-        eid = meta['next_id']
-        meta['next_id'] = eid + 1
-        meta['items'][str(eid)] = { 'chunkId': obj['chunkId'], 'docId': docId, 'order': obj.get('order', 0) }
-        ids.append(eid)
-        vec = embeddings[i].astype('float32')
-        vectors.append(vec)
-        stored_vectors[eid] = vec  # Store vector with its ID
-
-    if vectors:
-        xb = np.vstack(vectors)
-        index.add_with_ids(xb, np.array(ids, dtype='int64'))
-        faiss.write_index(index, index_path)
-        _save_meta(meta_path, meta)
-        np.save(vectors_path, stored_vectors)  # Save vectors store
-
-    return ids
-
-def search_user_index(userId: str, query_emb, top_k=5):
-    _, index_path, meta_path, _ = _user_paths(userId)
-    if not os.path.exists(index_path):
+    xb = np.ascontiguousarray(embeddings[:len(chunk_objs)], dtype='float32')
+
+    with _user_lock(userId).write():
+        manifest = _load_manifest(d)
+        old_stamp = _cache_stamp(userId, d)
+
+        start = manifest['next_id']
+        ids = np.arange(start, start + len(chunk_objs), dtype='int64')
+        name = f"seg-{manifest['next_seq']:06d}"
+        seg = _write_segment(d, name, ids, xb,
+                             [obj['chunkId'] for obj in chunk_objs],
+                             [docId] * len(chunk_objs),
+                             [obj.get('order', 0) for obj in chunk_objs])
+
+        manifest['segments'].append({ 'name': name, 'rows': len(ids) })
+        manifest['docs'].setdefault(str(docId), []).extend(_id_ranges(ids))
+        manifest['next_id'] = start + len(ids)
+        manifest['next_seq'] += 1
+        manifest['generation'] += 1
+        _save_manifest(d, manifest)
+        _bump_generation(userId)
+        answer_cache.invalidate(userId)
+
+        # Write-through: extend the resident index rather than reloading it
+        cached = _index_cache.peek(userId, old_stamp)
+        if cached is not None and cached[0].trained_on is not None:
+            # Its quantizer was trained on the segments it was loaded from;
+            # the next query reloads it trained on these vectors too
+            _index_cache.invalidate(userId)
+            cached = None
+        if cached is not None:
+            index, meta = cached
+            try:
+                with index.lock.write():
+                    index.add(xb, ids)
+                    meta['store'].add(open_segment_meta(seg))
+                    if 'vectors' in meta:
+                        meta['vectors'] = meta['vectors'] + [_read_segment(d, name)]
+                    meta['docs'] = manifest['docs']
+                    meta['next_id'] = manifest['next_id']
+                _cache_put(userId, _cache_stamp(userId, d), index, meta)
+            except Exception:
+                _index_cache.invalidate(userId)
+                raise
+
+    if _needs_compaction(manifest):
+        _schedule_compaction(userId)
+
+    return [int(eid) for eid in ids]
+
+def search_user_index(userId: str, query_emb, top_k=5, doc_ids=None):
+    """
+    Search a user's index. If doc_ids is given, only chunks of those
+    documents are considered (resolved via the docId index, no metadata scan).
+    """
+    return [hit for hits in search_user_index_batch(userId, query_emb, top_k, doc_ids) for hit in hits]
+
+def search_user_index_batch(userId: str, query_embs, top_k=5, doc_ids=None, route: bool = True) -> List[List[dict]]:
+    """
+    Search a user's index with a (N, dim) matrix of queries in one FAISS
+    call. Returns one list of hits per query row, in row order.
+    """
+    peer = shard_router.peer_for(userId) if route else None
+    if peer:
+        return shard_router.forward(peer, 'search', {
+            'userId': userId, 'query_embs': np.asarray(query_embs, dtype='float32').tolist(),
+            'top_k': top_k, 'doc_ids': doc_ids,
+        })
+    index, meta = _load_user_index(userId)
+    if index is None:
+        return [[] for _ in range(len(query_embs))]
+    # Cache hits share the index with writers: hold its read lock until the
+    # hits are resolved, so ids, vectors and metadata stay consistent
+    with index.lock.read():
+        ranges = scope = None
+        if doc_ids is not None:
+            scope = [str(docId) for docId in doc_ids]
+            ranges = [r for docId in scope for r in meta['docs'].get(docId, [])]
+        if 'vectors' in meta and meta['vectors']:
+            # Over-fetch from the (possibly quantized) index, then rank exactly
+            _, I = index.search(query_embs, top_k * RESCORE_FACTOR, ranges)
+            D, I = rescore(meta['vectors'], np.asarray(query_embs, dtype='float32'), I, top_k)
+        else:
+            D, I = index.search(query_embs, top_k, ranges)
+        results = []
+        for dist_row, id_row in zip(D, I):
+            hits = []
+            for dist, idx in zip(dist_row, id_row):
+                if idx == -1: continue
+                item = _chunk_meta(meta, idx, scope)
+                hits.append({ 'faissIndex': int(idx), 'score': float(dist), 'meta': item })
+            results.append(hits)
+    return results
+
+def _chunk_meta(meta, eid, doc_ids=None):
+    """
+    Row metadata for an id. A vector linked into several documents reports
+    the first document still referencing it, or the first one in doc_ids
+    when the lookup is scoped to some documents.
+    """
+    item = meta['store'].get(eid)
+    refs = meta.get('shared', {}).get(str(int(eid)))
+    if refs:
+        ref = next((r for r in refs if r['docId'] in doc_ids), refs[0]) if doc_ids else refs[0]
+        item = { **(item or {}), 'docId': ref['docId'], 'chunkId': ref['chunkId'] }
+    return item
+
+def stored_vectors(userId: str, ids, route: bool = True) -> np.ndarray:
+    """
+    Exact float32 vectors of the given ids, read from the memory-mapped
+    segment files (the resident index may be quantized). Rows of unknown
+    ids are zero.
+    """
+    ids = np.asarray(ids, dtype='int64')
+    peer = shard_router.peer_for(userId) if route else None
+    if peer:
+        return np.asarray(shard_router.forward(peer, 'vectors', { 'userId': userId, 'ids': ids.tolist() }), dtype='float32')
+    d = _user_path(userId)
+    if not len(ids) or not os.path.isdir(d):
+        return np.zeros((len(ids), 0), dtype='float32')
+    # The read lock keeps compaction from removing the files mid-read
+    with _user_lock(userId).read():
+        parts = _load_vectors(d, _load_manifest(d))
+        if not parts:
+            return np.zeros((len(ids), 0), dtype='float32')
+        return gather_vectors(parts, ids)
+
+def indexed_doc_ids(userId: str, route: bool = True) -> List[str]:
+    """docIds that currently have vectors in a user's index."""
+    peer = shard_router.peer_for(userId) if route else None
+    if peer:
+        return shard_router.forward(peer, 'docs', { 'userId': userId })
+    d = _user_path(userId)
+    if not os.path.isdir(d):
+        return []
+    with _user_lock(userId).read():
+        return sorted(_load_manifest(d)['docs'])
+
+def list_document_chunks(userId: str, docId: str) -> List[dict]:
+    """Metadata of every indexed chunk of one document, in id order."""
+    index, meta = _load_user_index(userId)
+    if index is None:
         return []
-    index = faiss.read_index(index_path)
-    D, I = index.search(query_emb.astype('float32'), top_k)
-    meta = _load_meta(meta_path)
     results = []
-    for dist_row, id_row in zip(D, I):
-        for dist, idx in zip(dist_row, id_row):
-            if idx == -1: continue
-            item = meta['items'].get(str(int(idx)))
-            results.append({ 'faissIndex': int(idx), 'score': float(dist), 'meta': item })
+    with index.lock.read():
+        for eid in _range_ids(meta['docs'].get(str(docId), [])):
+            results.append({ 'faissIndex': int(eid), 'meta': _chunk_meta(meta, eid, (str(docId),)) })
     return results
 
-def delete_document_vectors(userId: str, docId: str):
+def link_chunks_to_index(userId: str, docId: str, links: List[list], route: bool = True) -> List[bool]:
+    """
+    Make existing vectors part of docId as well, for chunks that duplicate
+    an already indexed chunk of another document. links holds
+    [chunkId, faissIndex] pairs. The id is added to docId's ranges, so
+    docId-scoped searches find it, and recorded in the manifest's 'shared'
+    table with every document referencing it. Its vector is only
+    tombstoned once none of them is left. Returns, per pair, whether it was
+    linked. False means the vector was deleted in the meantime, and the
+    caller should index the chunk itself.
+    """
+    if not links:
+        return []
+    peer = shard_router.peer_for(userId) if route else None
+    if peer:
+        linked = shard_router.forward(peer, 'link', { 'userId': userId, 'docId': docId, 'links': links })
+        answer_cache.invalidate(userId)
+        return linked
+    d = _user_dir(userId)
+    docId = str(docId)
+
+    with _user_lock(userId).write():
+        manifest = _load_manifest(d)
+        old_stamp = _cache_stamp(userId, d)
+        store = _open_meta_store(d, manifest)
+        shared = manifest['shared']
+
+        linked, new_ids = [], []
+        for chunkId, eid in links:
+            eid = int(eid)
+            refs = shared.get(str(eid))
+            if refs is None:
+                item = store.get(eid)
+                owner = str(item.get('docId')) if item else None
+                if owner is None or not _in_ranges(eid, manifest['docs'].get(owner, [])):
+                    linked.append(False)
+                    continue
+                if owner == docId:
+                    linked.append(True)
+                    continue
+                refs = shared[str(eid)] = [{ 'docId': owner, 'chunkId': item.get('chunkId') }]
+            if all(r['docId'] != docId for r in refs):
+                refs.append({ 'docId': docId, 'chunkId': chunkId })
+                new_ids.append(eid)
+            linked.append(True)
+
+        if new_ids:
+            manifest['docs'].setdefault(docId, []).extend(_id_ranges(sorted(set(new_ids))))
+            manifest['generation'] += 1
+            _save_manifest(d, manifest)
+            _bump_generation(userId)
+            answer_cache.invalidate(userId)
+
+            cached = _index_cache.peek(userId, old_stamp)
+            if cached is not None:
+                index, meta = cached
+                with index.lock.write():
+                    meta['docs'] = manifest['docs']
+                    meta['shared'] = shared
+                _cache_put(userId, _cache_stamp(userId, d), index, meta)
+
+    return linked
+
+def _in_ranges(eid, ranges):
+    return any(start <= eid < end for start, end in ranges)
+
+def delete_document_vectors(userId: str, docId: str, route: bool = True):
     """
-    Delete all vectors for a document and rebuild FAISS with sequential IDs starting from 1.
-    
-    Steps:
-    1. Load meta.json and vectors store
-    2. Filter out items where docId matches
-    3. Get remaining vectors from stored vectors
-    4. Create NEW FAISS index with IDs: 1, 2, 3, ...
-    5. Create NEW meta.json with IDs: 1, 2, 3, ...
-    6. Save both
+    Delete all vectors for a document.
+
+    The document's ids come from the manifest's docId index; they are recorded
+    as tombstones in the manifest and removed from the resident index with
+    remove_ids, so the cost depends on the document's size rather than the
+    corpus. Tombstoned rows are physically dropped by background compaction.
     """
-    import logging
-    import numpy as np
-    import faiss
-    
-    # Setup logging
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    logger = logging.getLogger(__name__)
-    
-    d, index_path, meta_path, vectors_path = _user_paths(userId)
-    
+    peer = shard_router.peer_for(userId) if route else None
+    if peer:
+        result = shard_router.forward(peer, 'delete', { 'userId': userId, 'docId': docId })
+        answer_cache.invalidate(userId)
+        return result
+    d = _user_dir(userId)
+
     try:
-        # STEP 1: Load meta.json
-        print(f"\n{'='*60}")
-        print(f"DELETE DOCUMENT: userId={userId}, docId={docId}")
-        print(f"{'='*60}")
-        print(f"\nSTEP 1: Load meta.json from {meta_path}")
-        
-        meta = _load_meta(meta_path)
-        old_count = len(meta['items'])
-        print(f"  ✓ Loaded meta.json with {old_count} vectors")
-        
-        # STEP 2: Filter items by docId
-        print(f"\nSTEP 2: Filter items (remove docId={docId})")
-        
-        remaining_chunks = []
-        deleted_ids = []
-        
-        for old_id_str, item in sorted(meta['items'].items(), key=lambda x: int(x[0])):
-            old_id = int(old_id_str)
-            if str(item.get('docId')) == str(docId):
-                deleted_ids.append(old_id)
-                print(f"  ✗ DELETE: ID {old_id} → docId={item.get('docId')}")
-            else:
-                remaining_chunks.append({
-                    'old_id': old_id,
-                    'chunkId': item['chunkId'],
-                    'docId': item['docId'],
-                    'order': item.get('order', 0)
-                })
-                print(f"  ✓ KEEP: ID {old_id} → docId={item.get('docId')}")
-        
-        deleted_count = len(deleted_ids)
-        new_count = len(remaining_chunks)
-        
-        print(f"\n  Summary: {deleted_count} deleted, {new_count} remaining")
-        
-        if deleted_count == 0:
-            print(f"  ⚠ No vectors found for docId={docId}")
-            return
-        
-        # STEP 3: Handle empty case
-        if new_count == 0:
-            print(f"\nSTEP 3-6: No vectors remaining → Clear everything")
-            if os.path.exists(index_path):
-                os.remove(index_path)
-                print(f"  ✓ Deleted FAISS index file")
-            if os.path.exists(vectors_path):
-                os.remove(vectors_path)
-                print(f"  ✓ Deleted vectors store file")
-            
-            _save_meta(meta_path, {'next_id': 1, 'items': {}})
-            print(f"  ✓ Saved empty meta.json")
-            print(f"\n{'='*60}")
-            print(f"COMPLETE: Deleted {deleted_count} vectors, 0 remaining")
-            print(f"{'='*60}\n")
-            return
-        
-        # STEP 3: Load stored vectors
-        print(f"\nSTEP 3: Load stored vectors from {vectors_path}")
-        
-        if not os.path.exists(vectors_path):
-            print(f"  ✗ ERROR: Vectors store not found at {vectors_path}")
-            return
-        
-        stored_vectors = np.load(vectors_path, allow_pickle=True).item()
-        print(f"  ✓ Loaded {len(stored_vectors)} stored vectors")
-        
-        # STEP 4: Get remaining vectors from store
-        print(f"\nSTEP 4: Extract {new_count} remaining vectors from store")
-        
-        remaining_vectors = []
-        for chunk in remaining_chunks:
-            old_id = chunk['old_id']
-            if old_id in stored_vectors:
-                remaining_vectors.append(stored_vectors[old_id])
-                print(f"  ✓ Retrieved vector for old_id={old_id}")
-            else:
-                print(f"  ✗ Vector not found for old_id={old_id}")
-        
-        if len(remaining_vectors) != new_count:
-            print(f"  ✗ ERROR: Only found {len(remaining_vectors)}/{new_count} vectors in store")
-            return
-        
-        # Get dimension from first vector
-        dim = remaining_vectors[0].shape[0]
-        print(f"  ✓ Vector dimension: {dim}")
-        
-        # STEP 5: Create NEW FAISS with sequential IDs
-        print(f"\nSTEP 5: Create NEW FAISS index with sequential IDs")
-        
-        index_flat = faiss.IndexFlatIP(dim)
-        new_index = faiss.IndexIDMap(index_flat)
-        
-        # NEW sequential IDs: 1, 2, 3, ...
-        new_ids = list(range(1, new_count + 1))
-        vectors_array = np.vstack(remaining_vectors).astype('float32')
-        new_index.add_with_ids(vectors_array, np.array(new_ids, dtype='int64'))
-        
-        print(f"  ✓ Created FAISS index with IDs: {new_ids}")
-        
-        # STEP 6: Create NEW meta.json and vectors store with sequential IDs
-        print(f"\nSTEP 6: Create NEW meta.json and vectors store with sequential IDs")
-        
-        new_meta_items = {}
-        new_stored_vectors = {}
-        for i in range(len(remaining_chunks)):
-            new_id = i + 1  # 1, 2, 3, ...
-            chunk = remaining_chunks[i]
-            new_meta_items[str(new_id)] = {
-                'chunkId': chunk['chunkId'],
-                'docId': chunk['docId'],
-                'order': chunk['order']
-            }
-            new_stored_vectors[new_id] = remaining_vectors[i]  # Store with new ID
-            print(f"  ✓ ID {new_id} → chunkId={chunk['chunkId'][:20]}..., docId={chunk['docId']}")
-        
-        next_id = new_count + 1
-        new_meta = {'next_id': next_id, 'items': new_meta_items}
-        
-        # STEP 7: Save everything
-        print(f"\nSTEP 7: Save FAISS index, meta.json, and vectors store")
-        
-        faiss.write_index(new_index, index_path)
-        print(f"  ✓ Saved FAISS index to {index_path}")
-        
-        _save_meta(meta_path, new_meta)
-        print(f"  ✓ Saved meta.json to {meta_path}")
-        
-        np.save(vectors_path, new_stored_vectors)
-        print(f"  ✓ Saved vectors store to {vectors_path}")
-        
-        # STEP 8: Verification
-        print(f"\nSTEP 8: Verification")
-        print(f"  Old vector count: {old_count}")
-        print(f"  Deleted vectors: {deleted_count}")
-        print(f"  New vector count: {new_count}")
-        print(f"  Next ID: {next_id}")
-        print(f"  FAISS IDs: {new_ids}")
-        print(f"  Meta IDs: {sorted([int(k) for k in new_meta_items.keys()])}")
-        
-        # Verify no gaps
-        meta_ids = sorted([int(k) for k in new_meta_items.keys()])
-        expected_ids = list(range(1, new_count + 1))
-        if meta_ids == expected_ids:
-            print(f"  ✓ NO GAPS: IDs are sequential 1-{new_count}")
-        else:
-            print(f"  ✗ ERROR: IDs have gaps!")
-        
-        print(f"\n{'='*60}")
-        print(f"COMPLETE: Deleted {deleted_count} vectors, {new_count} remaining")
-        print(f"{'='*60}\n")
-        
+        with _user_lock(userId).write():
+            manifest = _load_manifest(d)
+            old_stamp = _cache_stamp(userId, d)
+            ranges = manifest['docs'].pop(str(docId), [])
+
+            if not ranges:
+                print(f"⚠ DELETE: No vectors found for userId={userId}, docId={docId}")
+                return
+
+            ids = _range_ids(ranges)
+            shared = manifest['shared']
+            if shared:
+                # Vectors linked into other documents stay; only unreferenced ones are tombstoned
+                keep = np.zeros(len(ids), dtype=bool)
+                for pos in np.flatnonzero(np.isin(ids, np.array([int(k) for k in shared], dtype='int64'))):
+                    key = str(int(ids[pos]))
+                    refs = [r for r in shared[key] if r['docId'] != str(docId)]
+                    if refs:
+                        shared[key] = refs
+                        keep[pos] = True
+                    else:
+                        del shared[key]
+                if keep.any():
+                    ids = ids[~keep]
+                    ranges = _id_ranges(ids)
+            manifest['tombstones'].extend(ranges)
+            manifest['tombstone_rows'] += len(ids)
+            manifest['generation'] += 1
+            _save_manifest(d, manifest)
+            _bump_generation(userId)
+            answer_cache.invalidate(userId)
+
+            cached = _index_cache.peek(userId, old_stamp)
+            if cached is not None:
+                index, meta = cached
+                with index.lock.write():
+                    if len(ids):
+                        index.remove(ids)
+                    meta['docs'] = manifest['docs']
+                    meta['shared'] = manifest['shared']
+                _cache_put(userId, _cache_stamp(userId, d), index, meta)
+
+        print(f"✓ DELETE: userId={userId}, docId={docId}: {len(ids)} vectors tombstoned "
+              f"({manifest['tombstone_rows']} pending compaction)")
+
     except Exception as e:
         print(f"\n✗ ERROR: {e}")
         import traceback
         traceback.print_exc()
+        _index_cache.invalidate(userId)
         raise
+
+    if _needs_compaction(manifest):
+        _schedule_compaction(userId)
+
+# Executor workload of each forwarded operation, as for the local calls
+FORWARDED_WORKLOADS = {
+    'search': 'cpu',
+    'vectors': 'cpu',
+    'docs': 'disk',
+    'add': 'disk',
+    'link': 'disk',
+    'delete': 'disk',
+}
+
+def serve_forwarded(op: str, payload: dict):
+    """Run an index operation forwarded by another node's shard router, on this node."""
+    userId = payload['userId']
+    if op == 'search':
+        query_embs = np.asarray(payload['query_embs'], dtype='float32')
+        return search_user_index_batch(userId, query_embs, payload.get('top_k', 5), payload.get('doc_ids'), route=False)
+    if op == 'add':
+        embeddings = np.asarray(payload['embeddings'], dtype='float32')
+        return add_chunks_to_index(userId, payload['docId'], payload['chunk_objs'], embeddings, route=False)
+    if op == 'link':
+        return link_chunks_to_index(userId, payload['docId'], payload['links'], route=False)
+    if op == 'delete':
+        delete_document_vectors(userId, payload['docId'], route=False)
+        return None
+    if op == 'docs':
+        return indexed_doc_ids(userId, route=False)
+    if op == 'vectors':
+        return stored_vectors(userId, payload['ids'], route=False).tolist()
+    raise ValueError(f'Unknown index operation: {op}')
@@ -0,0 +1,95 @@
+"""
+Resident per-user FAISS index registry.
+
+Keeps recently used user indexes (and their metadata) in memory so that
+`/query-rag` does not re-read `index.faiss` and re-parse `meta.json` on every
+request. Entries are evicted in LRU order once the configured memory budget is
+exceeded, and are validated against a stamp (generation counter + file mtimes)
+so that writes from this or another process are picked up.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+# Approximate memory budget for resident indexes (bytes)
+CACHE_MAX_BYTES = int(os.environ.get('FAISS_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+class IndexCache:
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # userId -> (stamp, value, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, userId: str, stamp):
+        """Return the cached value for userId if its stamp is still current."""
+        with self._lock:
+            entry = self._entries.get(userId)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != stamp:
+                # Stale: index was rewritten since it was cached
+                self._drop(userId)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(userId)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, userId: str, stamp):
+        """Like get(), but without touching LRU order or counters (for writers)."""
+        with self._lock:
+            entry = self._entries.get(userId)
+            if entry is None or entry[0] != stamp:
+                return None
+            return entry[1]
+
+    def put(self, userId: str, stamp, value, nbytes: int):
+        with self._lock:
+            if userId in self._entries:
+                self._drop(userId)
+            if nbytes > self.max_bytes:
+                # Would evict everything else and still not fit: don't cache
+                return
+            self._entries[userId] = (stamp, value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, userId: str):
+        with self._lock:
+            if userId in self._entries:
+                self._drop(userId)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _drop(self, userId: str):
+        _, _, nbytes = self._entries.pop(userId)
+        self._bytes -= nbytes
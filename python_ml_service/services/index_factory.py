@@ -0,0 +1,319 @@
+"""
+FAISS index construction and type-specific search for per-user stores.
+
+Small users get an exact IndexFlatIP. When a user's base is rebuilt (at
+compaction) with at least FAISS_PROMOTE_THRESHOLD vectors, it is trained and
+promoted to the approximate index named by FAISS_APPROX_INDEX:
+
+    ivf     IndexIVFFlat   inverted lists over exact vectors
+    hnsw    IndexHNSWFlat  graph search; can't remove_ids, so deletes are
+                           filtered out of results until the next compaction
+    ivfpq   IndexIVFPQ     inverted lists over product-quantized codes
+
+FAISS_INDEX_TYPE forces one type for every user instead of 'auto'. Use
+benchmarks/bench_index_types.py to pick thresholds for a given corpus.
+
+FAISS_VECTOR_STORAGE=fp16 or sq8 replaces the exact float32 index with an
+IndexScalarQuantizer holding 2 or 1 bytes per dimension (types 'fp16' and
+'sq8'). The float32 vectors.npy files stay on disk, memory-mapped, so
+FAISS_RESCORE_FACTOR can re-rank the top candidates exactly (see rescore).
+"""
+import os
+import math
+import numpy as np
+import faiss
+
+from services.user_lock import RWLock
+
+INDEX_TYPE = os.environ.get('FAISS_INDEX_TYPE', 'auto')
+APPROX_INDEX = os.environ.get('FAISS_APPROX_INDEX', 'ivf')
+PROMOTE_THRESHOLD = int(os.environ.get('FAISS_PROMOTE_THRESHOLD', 50000))
+
+IVF_NLIST = int(os.environ.get('FAISS_IVF_NLIST', 0))  # 0: 4 * sqrt(N)
+IVF_NPROBE = int(os.environ.get('FAISS_IVF_NPROBE', 16))
+HNSW_M = int(os.environ.get('FAISS_HNSW_M', 32))
+HNSW_EF_CONSTRUCTION = int(os.environ.get('FAISS_HNSW_EF_CONSTRUCTION', 200))
+HNSW_EF_SEARCH = int(os.environ.get('FAISS_HNSW_EF_SEARCH', 128))
+PQ_M = int(os.environ.get('FAISS_PQ_M', 48))  # sub-quantizers; must divide dim
+PQ_NBITS = 8
+# Resident representation of exact (non-approximate) indexes: float32, fp16 or sq8
+VECTOR_STORAGE = os.environ.get('FAISS_VECTOR_STORAGE', 'float32')
+EXACT_KIND = { 'float32': 'flat', 'fp16': 'fp16', 'sq8': 'sq8' }[VECTOR_STORAGE]
+# Search this many times top_k candidates and re-rank them with the float32 vectors (0/1: off)
+RESCORE_FACTOR = int(os.environ.get('FAISS_RESCORE_FACTOR', 0))
+
+# faiss warns below 39 training points per centroid
+MIN_TRAIN_PER_LIST = 39
+TRAIN_PER_LIST = 64
+SQ_TRAIN_SIZE = 65536
+# PQ codebooks have 2**PQ_NBITS centroids per sub-quantizer, trained regardless of nlist
+PQ_MIN_TRAIN = (1 << PQ_NBITS) * MIN_TRAIN_PER_LIST
+ADD_BATCH = 65536
+
+KINDS = ('flat', 'fp16', 'sq8', 'ivf', 'hnsw', 'ivfpq')
+# Kinds whose quantizer is trained on the data, so a rebuilt base differs from the old one
+TRAINED_KINDS = ('sq8', 'ivf', 'ivfpq')
+SQ_TYPES = { 'fp16': faiss.ScalarQuantizer.QT_fp16, 'sq8': faiss.ScalarQuantizer.QT_8bit }
+
+
+def _nlist(n_vectors: int) -> int:
+    return IVF_NLIST or max(1, int(4 * math.sqrt(n_vectors)))
+
+
+def _min_train(kind: str, n_vectors: int) -> int:
+    """Fewest training points for an IVF kind without faiss under-training it."""
+    n = _nlist(n_vectors) * MIN_TRAIN_PER_LIST
+    return max(n, PQ_MIN_TRAIN) if kind == 'ivfpq' else n
+
+
+def choose_kind(n_vectors: int) -> str:
+    """Index type for a base of n_vectors, falling back to flat when IVF can't be trained."""
+    if INDEX_TYPE != 'auto':
+        kind = INDEX_TYPE
+    elif n_vectors < PROMOTE_THRESHOLD:
+        kind = EXACT_KIND
+    else:
+        kind = APPROX_INDEX
+    if kind in ('ivf', 'ivfpq') and n_vectors < _min_train(kind, n_vectors):
+        return EXACT_KIND
+    return kind
+
+
+def new_index(kind: str, dim: int, n_vectors: int = 0):
+    if kind == 'flat':
+        return faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+    if kind in SQ_TYPES:
+        return faiss.IndexIDMap(faiss.IndexScalarQuantizer(dim, SQ_TYPES[kind], faiss.METRIC_INNER_PRODUCT))
+    if kind == 'hnsw':
+        hnsw = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return faiss.IndexIDMap(hnsw)
+    quantizer = faiss.IndexFlatIP(dim)
+    if kind == 'ivf':
+        return faiss.IndexIVFFlat(quantizer, dim, _nlist(n_vectors), faiss.METRIC_INNER_PRODUCT)
+    if kind == 'ivfpq':
+        return faiss.IndexIVFPQ(quantizer, dim, _nlist(n_vectors), PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f'Unknown FAISS index type: {kind}')
+
+
+def _training_sample(parts, n_train: int):
+    """Evenly spaced rows across all (ids, vectors) parts, so memmapped parts are read sparsely."""
+    total = sum(len(ids) for ids, _ in parts)
+    if total <= n_train:
+        return np.vstack([np.asarray(vectors, dtype='float32') for _, vectors in parts])
+    picks = np.linspace(0, total - 1, n_train).astype('int64')
+    sample = []
+    offset = 0
+    for ids, vectors in parts:
+        local = picks[(picks >= offset) & (picks < offset + len(ids))] - offset
+        if len(local):
+            sample.append(np.asarray(vectors[local], dtype='float32'))
+        offset += len(ids)
+    return np.vstack(sample)
+
+
+def build_index(kind: str, parts, dim: int):
+    """Create, train if needed, and fill an index of the given kind from (ids, vectors) parts."""
+    total = sum(len(ids) for ids, _ in parts)
+    index = new_index(kind, dim, total)
+    if not index.is_trained:
+        if kind in SQ_TYPES:
+            n_train = SQ_TRAIN_SIZE
+        elif kind == 'ivfpq':
+            n_train = min(total, max(_nlist(total) * TRAIN_PER_LIST, PQ_MIN_TRAIN))
+        else:
+            n_train = _nlist(total) * TRAIN_PER_LIST
+        index.train(_training_sample(parts, n_train))
+    for ids, vectors in parts:
+        for start in range(0, len(ids), ADD_BATCH):
+            end = start + ADD_BATCH
+            index.add_with_ids(np.ascontiguousarray(vectors[start:end], dtype='float32'),
+                               np.ascontiguousarray(ids[start:end], dtype='int64'))
+    return index
+
+
+def index_kind(index) -> str:
+    if isinstance(index, faiss.IndexIDMap):
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            return 'hnsw'
+        if isinstance(inner, faiss.IndexScalarQuantizer):
+            return 'fp16' if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'sq8'
+        return 'flat'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivfpq'
+    return 'ivf'
+
+
+def _range_selector(ranges):
+    if len(ranges) == 1:
+        return faiss.IDSelectorRange(int(ranges[0][0]), int(ranges[0][1]))
+    return faiss.IDSelectorBatch(np.concatenate([np.arange(lo, hi, dtype='int64') for lo, hi in ranges]))
+
+
+class UserIndex:
+    """
+    A user's resident FAISS index, with removal and id-range filtering that
+    work the same across index types.
+
+    FAISS indexes can't be searched while ids are added or removed, and
+    add()/remove() also reset the id-map memo and the dead set that
+    search() reads. Once the index is shared (in the index cache), callers
+    hold lock.read() around search() and lock.write() around add() and
+    remove(), and around changes to the metadata cached alongside it.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.lock = RWLock()
+        self.kind = index_kind(index)
+        self.dead = set()  # removed ids still in an index that can't drop them (hnsw)
+        self.trained_on = None  # vectors it trained itself on, when not read from a base
+        self._id_map = None
+        if self.kind in ('ivf', 'ivfpq'):
+            index.nprobe = IVF_NPROBE
+        elif self.kind == 'hnsw':
+            faiss.downcast_index(index.index).hnsw.efSearch = HNSW_EF_SEARCH
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal - len(self.dead)
+
+    def nbytes(self) -> int:
+        """Approximate resident size."""
+        n, d = self.index.ntotal, self.index.d
+        if self.kind == 'ivfpq':
+            return n * (PQ_M + 8) + d * 4 * self.index.nlist
+        if self.kind == 'ivf':
+            return n * (d * 4 + 8) + d * 4 * self.index.nlist
+        if self.kind == 'hnsw':
+            return n * (d * 4 + 8 + HNSW_M * 2 * 4)
+        if self.kind == 'fp16':
+            return n * (d * 2 + 8)
+        if self.kind == 'sq8':
+            return n * (d + 8)
+        return n * (d * 4 + 8)
+
+    def train(self, parts):
+        """Train on a sample of (ids, vectors) parts: a store without a base yet (sq8). Compaction retrains on every vector."""
+        self.index.train(_training_sample(parts, SQ_TRAIN_SIZE))
+        self.trained_on = sum(len(ids) for ids, _ in parts)
+
+    def add(self, xb, ids):
+        xb = np.ascontiguousarray(xb, dtype='float32')
+        if not self.index.is_trained:
+            self.train([(ids, xb)])
+        self.index.add_with_ids(xb, np.ascontiguousarray(ids, dtype='int64'))
+        self._id_map = None
+
+    def remove(self, ids):
+        if self.kind == 'hnsw':
+            self.dead.update(int(eid) for eid in ids)
+        else:
+            self.index.remove_ids(np.ascontiguousarray(ids, dtype='int64'))
+        self._id_map = None
+
+    def search(self, xq, k: int, ranges=None):
+        """(D, I) like Index.search, with external ids; ranges restricts results to those [start, end) id ranges."""
+        xq = np.ascontiguousarray(xq, dtype='float32')
+        if ranges is None:
+            return self._search_all(xq, k)
+        if not ranges:
+            return self._empty(len(xq), k)
+        if self.kind in ('ivf', 'ivfpq'):
+            # Probe every list: the selector skips non-members cheaply, and a
+            # small document may sit in lists the default nprobe would miss
+            params = faiss.SearchParametersIVF()
+            params.sel = _range_selector(ranges)
+            params.nprobe = self.index.nlist
+            return self.index.search(xq, k, params=params)
+        bounds = self._positions(ranges)
+        if not bounds:
+            return self._empty(len(xq), k)
+        inner = faiss.downcast_index(self.index.index)
+        if self.kind == 'hnsw':
+            # HNSW's filtered search can dead-end on small selections;
+            # a document is small, so score its vectors exactly instead
+            return self._search_positions(inner, xq, k, bounds)
+        # IndexIDMap doesn't accept search params, so filter the wrapped
+        # flat / scalar-quantized index by position
+        params = faiss.SearchParameters()
+        if len(bounds) == 1:
+            params.sel = faiss.IDSelectorRange(*bounds[0])
+        else:
+            params.sel = faiss.IDSelectorBatch(np.concatenate([np.arange(lo, hi, dtype='int64') for lo, hi in bounds]))
+        D, P = inner.search(xq, k, params=params)
+        return D, np.where(P >= 0, self._positions_to_ids()[P], -1)
+
+    def _search_all(self, xq, k):
+        if not self.dead:
+            return self.index.search(xq, k)
+        # Over-fetch so that k live results survive dropping removed ids
+        D, I = self.index.search(xq, min(k + len(self.dead), self.index.ntotal))
+        out_D, out_I = self._empty(len(xq), k)
+        for row, (dist_row, id_row) in enumerate(zip(D, I)):
+            live = [(dist, eid) for dist, eid in zip(dist_row, id_row) if eid != -1 and int(eid) not in self.dead][:k]
+            for col, (dist, eid) in enumerate(live):
+                out_D[row, col] = dist
+                out_I[row, col] = eid
+        return out_D, out_I
+
+    def _search_positions(self, inner, xq, k, bounds):
+        vectors = np.vstack([inner.reconstruct_n(lo, hi - lo) for lo, hi in bounds])
+        positions = np.concatenate([np.arange(lo, hi, dtype='int64') for lo, hi in bounds])
+        scores = xq @ vectors.T
+        out_D, out_I = self._empty(len(xq), k)
+        top = np.argsort(-scores, axis=1)[:, :k]
+        for row in range(len(xq)):
+            n = len(top[row])
+            out_D[row, :n] = scores[row, top[row]]
+            out_I[row, :n] = self._positions_to_ids()[positions[top[row]]]
+        return out_D, out_I
+
+    def _positions_to_ids(self):
+        """External ids by position in the wrapped index (memoized until the index changes)."""
+        id_map = self._id_map
+        if id_map is None:
+            id_map = self._id_map = faiss.vector_to_array(self.index.id_map)
+        return id_map
+
+    def _positions(self, ranges):
+        """
+        Contiguous position ranges in the wrapped index covering the given id
+        ranges. Ids are always appended in increasing order (and remove_ids
+        keeps order), so the id map is sorted.
+        """
+        id_map = self._positions_to_ids()
+        bounds = [np.searchsorted(id_map, [start, end]) for start, end in ranges]
+        return [(int(lo), int(hi)) for lo, hi in bounds if hi > lo]
+
+    @staticmethod
+    def _empty(nq, k):
+        return np.full((nq, k), -np.inf, dtype='float32'), np.full((nq, k), -1, dtype='int64')
+
+
+def gather_vectors(parts, ids):
+    """Float32 vectors of the given ids from sorted (ids, vectors) parts (memory-mapped rows are read on demand)."""
+    out = np.zeros((len(ids), parts[0][1].shape[1]), dtype='float32')
+    for part_ids, vectors in parts:
+        pos = np.searchsorted(part_ids, ids)
+        found = pos < len(part_ids)
+        found[found] = part_ids[pos[found]] == ids[found]
+        if found.any():
+            out[found] = vectors[pos[found]]
+    return out
+
+
+def rescore(parts, xq, I, k):
+    """Re-rank candidate ids I (one row per query) by exact float32 inner product; keep the best k."""
+    out_D = np.full((len(I), k), -np.inf, dtype='float32')
+    out_I = np.full((len(I), k), -1, dtype='int64')
+    for row, ids in enumerate(I):
+        ids = ids[ids != -1]
+        if not len(ids):
+            continue
+        scores = gather_vectors(parts, ids) @ xq[row]
+        best = np.argsort(-scores)[:k]
+        out_D[row, :len(best)] = scores[best]
+        out_I[row, :len(best)] = ids[best]
+    return out_D, out_I
@@ -1,16 +1,20 @@
 
 import os
-from services.embeddings import embed_texts
-from services.faiss_index import search_user_index
+from services.embeddings import embed_texts_async
+from services.faiss_index import search_user_index, search_user_index_batch
 import openai
+from services import answer_cache
+from services.executors import run, run_iter
 from services.mongo import chunks_collection
-from utils.text_utils import extract_best_sentence
+from utils.text_utils import extract_best_sentences
 import re
 
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
 CHAT_MODEL_DEFAULT = os.environ.get("OPENAI_CHAT_MODEL", "gpt-4.1-mini")
 RELEVANCE_THRESHOLD = float(os.environ.get("RELEVANCE_THRESHOLD", 0.60))
+# Sentences of each retrieved chunk sent to the LLM, those closest to the query; 0 sends whole chunks
+CONTEXT_SENTENCES = int(os.environ.get("RAG_CONTEXT_SENTENCES", 4))
 
 def get_chunk_texts_by_ids(chunk_ids, userId):
     if not chunk_ids:
@@ -32,23 +36,8 @@ def get_chunk_texts_by_ids(chunk_ids, userId):
     )
 
 
-async def query_rag(
-    userId: str,
-    query: str,
-    emotion: str = "neutral",
-    history: list = None
-):
-
-    # 1️⃣ Embed query
-    query_embedding = embed_texts([query])
-
-    # 2️⃣ FAISS search
-    results = search_user_index(userId, query_embedding, top_k=5)
-
-    print(f"\nQuery: {query}")
-    print(f"Total retrieved chunks: {len(results)}")
-
-    # 3️⃣ Convert FAISS distance → similarity
+def select_relevant_results(results, verbose=True):
+    """Add a similarity to each FAISS hit; return the hits above RELEVANCE_THRESHOLD and their chunkIds."""
     relevant_results = []
     chunk_ids = []
 
@@ -57,10 +46,11 @@ async def query_rag(
         similarity = 1 / (1 + distance)
         r["similarity"] = similarity
 
-        print(
-            f"RAW DISTANCE: {distance:.4f} "
-            f"=> SIMILARITY: {similarity:.3f}"
-        )
+        if verbose:
+            print(
+                f"RAW DISTANCE: {distance:.4f} "
+                f"=> SIMILARITY: {similarity:.3f}"
+            )
 
         if similarity >= RELEVANCE_THRESHOLD:
             relevant_results.append(r)
@@ -71,41 +61,203 @@ async def query_rag(
             if chunk_id:
                 chunk_ids.append(chunk_id)
 
+    if verbose:
+        print(
+            f"Relevant (similarity >= {RELEVANCE_THRESHOLD}): "
+            f"{len(relevant_results)}"
+        )
 
-    print(
-        f"Relevant (similarity >= {RELEVANCE_THRESHOLD}): "
-        f"{len(relevant_results)}"
-    )
+    return relevant_results, chunk_ids
 
-    # 4️⃣ Fetch chunk texts from MongoDB
-    context_texts = []
+
+def context_excerpts(query_embedding, chunk_docs):
+    """The CONTEXT_SENTENCES sentences of each chunk closest to the query, joined; None when whole chunks are used."""
+    if CONTEXT_SENTENCES <= 0 or not chunk_docs:
+        return None
+    best = extract_best_sentences(query_embedding, [doc.get("text", "") for doc in chunk_docs], CONTEXT_SENTENCES)
+    return [" ".join(sentences) for sentences in best]
+
+
+def build_context(chunk_docs, excerpts=None):
+    """Numbered context blocks for the prompt and the matching source entries."""
     sources = []
     context_blocks = []
-    
-    if chunk_ids:
-        chunk_docs = get_chunk_texts_by_ids(chunk_ids, userId)
-
-        for idx, doc in enumerate(chunk_docs, start=1):
-            text = doc.get("text", "")
-            
-            if not text:
-                continue
-
-            # Build labeled context block
-            block = f"[{idx}] {doc['docName']} (Page {doc['pageNumber']})\n{text}"
-            context_blocks.append(block)
-
-            # Build source metadata (no best_sentence)
-            sources.append({
-                "number": idx,
-                "chunkId": doc.get("chunkId"),
-                "docName": doc.get("docName"),
-                "pageNumber": doc.get("pageNumber"),
-                "snippet": text[:300]
-            })  
-                
-
-   
+
+    for idx, doc in enumerate(chunk_docs, start=1):
+        text = doc.get("text", "")
+
+        if not text:
+            continue
+
+        # Build labeled context block, from the chunk's best sentences when given
+        excerpt = excerpts[idx - 1] if excerpts else text
+        block = f"[{idx}] {doc['docName']} (Page {doc['pageNumber']})\n{excerpt}"
+        context_blocks.append(block)
+
+        # Build source metadata (no best_sentence)
+        sources.append({
+            "number": idx,
+            "chunkId": doc.get("chunkId"),
+            "docName": doc.get("docName"),
+            "pageNumber": doc.get("pageNumber"),
+            "snippet": text[:300]
+        })
+
+    return context_blocks, sources
+
+
+def answer_confidence(relevant_results):
+    return round(
+        sum(r["similarity"] for r in relevant_results)
+        / max(len(relevant_results), 1),
+        2
+    )
+
+
+async def search_relevant(userId: str, query: str, doc_ids: list = None):
+    """The query's embedding, its relevant FAISS hits and their chunkIds."""
+
+    # 1️⃣ Embed query
+    query_embedding = await embed_texts_async([query])
+
+    # 2️⃣ FAISS search (optionally scoped to specific documents)
+    results = await run('cpu', search_user_index, userId, query_embedding, top_k=5, doc_ids=doc_ids)
+
+    print(f"\nQuery: {query}")
+    print(f"Total retrieved chunks: {len(results)}")
+
+    # 3️⃣ Convert FAISS distance → similarity
+    relevant_results, chunk_ids = select_relevant_results(results)
+    return query_embedding[0], relevant_results, chunk_ids
+
+
+async def fetch_context(userId: str, query_embedding, chunk_ids):
+    """Context blocks and sources for the relevant chunks."""
+
+    # 4️⃣ Fetch chunk texts from MongoDB
+    chunk_docs = await run('network', get_chunk_texts_by_ids, chunk_ids, userId)
+    excerpts = await run('cpu', context_excerpts, query_embedding, chunk_docs)
+    return build_context(chunk_docs, excerpts)
+
+
+async def query_rag(
+    userId: str,
+    query: str,
+    emotion: str = "neutral",
+    history: list = None,
+    doc_ids: list = None
+):
+    generation = answer_cache.generation(userId)
+    query_embedding, relevant_results, chunk_ids = await search_relevant(userId, query, doc_ids)
+
+    # Same question over the same chunks: reuse the answer, skip MongoDB and the LLM
+    cached = answer_cache.lookup(userId, query_embedding, emotion, history, chunk_ids)
+    if cached is not None:
+        cached["confidence"] = answer_confidence(relevant_results)
+        return cached
+
+    context_blocks, sources = await fetch_context(userId, query_embedding, chunk_ids)
+    result = await run('network', generate_answer, query, emotion, history, context_blocks, sources, relevant_results)
+    usage = result.pop("usage", None) or {}
+    answer_cache.store(userId, generation, query_embedding, emotion, history, chunk_ids, result, usage.get("total_tokens"))
+    return result
+
+
+async def query_rag_stream(
+    userId: str,
+    query: str,
+    emotion: str = "neutral",
+    history: list = None,
+    doc_ids: list = None
+):
+    """
+    query_rag that streams the answer. Retrieval is done before this
+    returns; the result is an async iterator of ("token", text) events as
+    the LLM produces them, then one ("done", {answer, sources, confidence}).
+    A cached answer comes back as a single token event.
+    """
+    generation = answer_cache.generation(userId)
+    query_embedding, relevant_results, chunk_ids = await search_relevant(userId, query, doc_ids)
+
+    cached = answer_cache.lookup(userId, query_embedding, emotion, history, chunk_ids)
+    if cached is not None:
+        cached["confidence"] = answer_confidence(relevant_results)
+        return _replay(cached)
+
+    context_blocks, sources = await fetch_context(userId, query_embedding, chunk_ids)
+    events = run_iter('network', stream_answer(query, emotion, history, context_blocks, sources, relevant_results))
+    return _cache_when_done(events, userId, generation, query_embedding, emotion, history, chunk_ids)
+
+
+async def _replay(result):
+    yield "token", result["answer"]
+    yield "done", result
+
+
+async def _cache_when_done(events, userId, generation, query_embedding, emotion, history, chunk_ids):
+    try:
+        async for event, data in events:
+            if event == "done":
+                usage = data.pop("usage", None) or {}
+                answer_cache.store(userId, generation, query_embedding, emotion, history, chunk_ids, data, usage.get("total_tokens"))
+            yield event, data
+    finally:
+        await events.aclose()
+
+
+async def query_rag_batch(
+    userId: str,
+    queries: list,
+    emotion: str = "neutral",
+    history: list = None,
+    doc_ids: list = None,
+    top_k: int = 5,
+    generate: bool = False
+):
+    """
+    Run several queries for one user with a single embedding call, a
+    single FAISS search and a single MongoDB lookup. Returns one result per
+    query, in order: its hits and sources, plus the answer when generate
+    is set (one LLM call per query).
+    """
+    if not queries:
+        return []
+
+    query_embeddings = await embed_texts_async(list(queries))
+    batch_results = await run('cpu', search_user_index_batch, userId, query_embeddings, top_k=top_k, doc_ids=doc_ids)
+
+    print(f"\nBatch query: {len(queries)} queries")
+    print(f"Total retrieved chunks: {sum(len(results) for results in batch_results)}")
+
+    selected = [select_relevant_results(results, verbose=False) for results in batch_results]
+
+    # Chunk texts for every query in one round trip
+    all_chunk_ids = list(dict.fromkeys(c for _, chunk_ids in selected for c in chunk_ids))
+    docs_by_id = {doc["chunkId"]: doc for doc in await run('network', get_chunk_texts_by_ids, all_chunk_ids, userId)}
+
+    answers = []
+    for query, query_embedding, results, (relevant_results, chunk_ids) in zip(queries, query_embeddings, batch_results, selected):
+        chunk_docs = [docs_by_id[c] for c in dict.fromkeys(chunk_ids) if c in docs_by_id]
+
+        item = {"query": query, "hits": results}
+        if generate:
+            excerpts = await run('cpu', context_excerpts, query_embedding, chunk_docs)
+            context_blocks, sources = build_context(chunk_docs, excerpts)
+            answer = await run('network', generate_answer, query, emotion, history, context_blocks, sources, relevant_results)
+            answer.pop("usage", None)
+            item.update(answer)
+        else:
+            _, sources = build_context(chunk_docs)
+            item["sources"] = sources
+            item["confidence"] = answer_confidence(relevant_results)
+        answers.append(item)
+
+    return answers
+
+
+def build_messages(query, emotion, history, context_blocks):
+    """The emotion-aware prompt around the retrieved context, with its temperature and max_tokens."""
+
     # 5️⃣ Conversation history
     history_msgs = history[-8:] if history else []
 
@@ -239,19 +391,11 @@ async def query_rag(
         }
     )
 
-    # 7️⃣ LLM call with emotion-aware parameters
-    model_name = os.environ.get(
-        "OPENAI_CHAT_MODEL", CHAT_MODEL_DEFAULT
-    )
+    return messages, response_temperature, response_max_tokens
 
-    response = openai.ChatCompletion.create(
-        model=model_name,
-        messages=messages,
-        temperature=response_temperature,  # Emotion-based
-        max_tokens=response_max_tokens,    # Emotion-based
-    )
 
-    answer = response["choices"][0]["message"]["content"]
+def finish_answer(answer, sources, relevant_results):
+    """The answer with the sources it cites and the retrieval confidence."""
 
     # citation numbers inside the llm output answer
     used_numbers = set(map(int, re.findall(r'\[(\d+)\]', answer)))
@@ -264,14 +408,69 @@ async def query_rag(
 
     sources = [s for s in sources if s["number"] in used_numbers]
 
-    confidence = round(
-        sum(r["similarity"] for r in relevant_results)
-        / max(len(relevant_results), 1),
-        2
-    )
+    confidence = answer_confidence(relevant_results)
 
     return {
         "answer": answer,
         "sources": sources,
         "confidence": confidence
     }
+
+
+def generate_answer(query, emotion, history, context_blocks, sources, relevant_results):
+    """
+    Build the emotion-aware prompt around the retrieved context and ask the
+    LLM. The result's "usage" holds the call's token counts.
+    """
+    messages, response_temperature, response_max_tokens = build_messages(query, emotion, history, context_blocks)
+
+    # 7️⃣ LLM call with emotion-aware parameters
+    model_name = os.environ.get(
+        "OPENAI_CHAT_MODEL", CHAT_MODEL_DEFAULT
+    )
+
+    response = openai.ChatCompletion.create(
+        model=model_name,
+        messages=messages,
+        temperature=response_temperature,  # Emotion-based
+        max_tokens=response_max_tokens,    # Emotion-based
+    )
+
+    answer = response["choices"][0]["message"]["content"]
+    result = finish_answer(answer, sources, relevant_results)
+    result["usage"] = dict(response.get("usage") or {})
+    return result
+
+
+def stream_answer(query, emotion, history, context_blocks, sources, relevant_results):
+    """
+    generate_answer with a streamed LLM call (blocking generator): yields
+    ("token", text) per content delta, then ("done", result), with an
+    estimated "usage".
+    """
+    messages, response_temperature, response_max_tokens = build_messages(query, emotion, history, context_blocks)
+    model_name = os.environ.get(
+        "OPENAI_CHAT_MODEL", CHAT_MODEL_DEFAULT
+    )
+
+    response = openai.ChatCompletion.create(
+        model=model_name,
+        messages=messages,
+        temperature=response_temperature,
+        max_tokens=response_max_tokens,
+        stream=True,
+    )
+
+    parts = []
+    for chunk in response:
+        choices = chunk.get("choices") or [{}]
+        text = (choices[0].get("delta") or {}).get("content")
+        if text:
+            parts.append(text)
+            yield "token", text
+
+    result = finish_answer("".join(parts), sources, relevant_results)
+    # Streamed responses report no usage: ~4 characters per prompt token, one token per delta
+    prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+    result["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": len(parts), "total_tokens": prompt_tokens + len(parts)}
+    yield "done", result
@@ -0,0 +1,150 @@
+"""
+Compact columnar chunk metadata, one set of files per index segment.
+
+    ids.npy            int64, sorted (shared with the segment's vectors)
+    order.npy          int32 chunk order within its document
+    doc.npy            int32 code into doc_table.json
+    doc_table.json     interned docId strings of this segment
+    chunk_offsets.npy  int64 (N + 1) byte offsets into chunk_ids.bin
+    chunk_ids.bin      utf-8 chunkIds, concatenated
+
+Everything except the (small) doc table is memory-mapped, so opening a
+segment costs nothing up front and looking up the metadata of a search hit
+is a binary search over ids.npy plus a couple of slices. Segments written
+before this format carry a meta.json instead and are parsed in full.
+"""
+import os
+import json
+import numpy as np
+
+COLUMN_FILES = ('order.npy', 'doc.npy', 'doc_table.json', 'chunk_offsets.npy', 'chunk_ids.bin')
+
+
+def write_meta(seg_dir: str, chunk_ids, doc_ids, orders):
+    """Write the metadata columns for rows already stored (in id order) in seg_dir/ids.npy."""
+    doc_table = []
+    doc_codes = {}
+    codes = np.empty(len(doc_ids), dtype='int32')
+    for i, docId in enumerate(doc_ids):
+        docId = str(docId)
+        if docId not in doc_codes:
+            doc_codes[docId] = len(doc_table)
+            doc_table.append(docId)
+        codes[i] = doc_codes[docId]
+
+    encoded = [c.encode('utf8') for c in chunk_ids]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype='int64')
+
+    np.save(os.path.join(seg_dir, 'order.npy'), np.asarray(orders, dtype='int32'))
+    np.save(os.path.join(seg_dir, 'doc.npy'), codes)
+    np.save(os.path.join(seg_dir, 'chunk_offsets.npy'), offsets)
+    with open(os.path.join(seg_dir, 'chunk_ids.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    with open(os.path.join(seg_dir, 'doc_table.json'), 'w', encoding='utf8') as f:
+        json.dump(doc_table, f)
+
+
+def has_columns(seg_dir: str) -> bool:
+    return all(os.path.exists(os.path.join(seg_dir, name)) for name in ('ids.npy',) + COLUMN_FILES)
+
+
+class SegmentMeta:
+    """Memory-mapped columnar metadata of one segment."""
+
+    def __init__(self, seg_dir: str):
+        self.ids = np.load(os.path.join(seg_dir, 'ids.npy'), mmap_mode='r')
+        self.order = np.load(os.path.join(seg_dir, 'order.npy'), mmap_mode='r')
+        self.doc = np.load(os.path.join(seg_dir, 'doc.npy'), mmap_mode='r')
+        self.chunk_offsets = np.load(os.path.join(seg_dir, 'chunk_offsets.npy'), mmap_mode='r')
+        blob_path = os.path.join(seg_dir, 'chunk_ids.bin')
+        if os.path.getsize(blob_path):
+            self.chunk_blob = np.memmap(blob_path, dtype='uint8', mode='r')
+        else:
+            self.chunk_blob = np.empty(0, dtype='uint8')
+        with open(os.path.join(seg_dir, 'doc_table.json'), 'r', encoding='utf8') as f:
+            self.doc_table = json.load(f)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def bounds(self):
+        return int(self.ids[0]), int(self.ids[-1])
+
+    def get(self, eid: int):
+        pos = int(np.searchsorted(self.ids, eid))
+        if pos >= len(self.ids) or self.ids[pos] != eid:
+            return None
+        return self._row(pos)
+
+    def rows(self):
+        for pos in range(len(self.ids)):
+            yield int(self.ids[pos]), self._row(pos)
+
+    def _row(self, pos):
+        start, end = self.chunk_offsets[pos], self.chunk_offsets[pos + 1]
+        return {
+            'chunkId': bytes(self.chunk_blob[start:end]).decode('utf8'),
+            'docId': self.doc_table[self.doc[pos]],
+            'order': int(self.order[pos]),
+        }
+
+
+class JsonSegmentMeta:
+    """Metadata from a meta.json file ({'items': {id: item}}), written before the columnar format."""
+
+    def __init__(self, meta_path: str):
+        with open(meta_path, 'r', encoding='utf8') as f:
+            self.items = json.load(f)['items']
+
+    def __len__(self):
+        return len(self.items)
+
+    def bounds(self):
+        ids = [int(eid) for eid in self.items]
+        return min(ids), max(ids)
+
+    def get(self, eid: int):
+        return self.items.get(str(int(eid)))
+
+    def rows(self):
+        for eid in sorted(self.items, key=int):
+            yield int(eid), self.items[eid]
+
+
+def open_segment_meta(seg_dir: str, meta_path: str = None):
+    """Open a segment's metadata, or None if it has none. meta_path overrides the meta.json location."""
+    if has_columns(seg_dir):
+        return SegmentMeta(seg_dir)
+    meta_path = meta_path or os.path.join(seg_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        return JsonSegmentMeta(meta_path)
+    return None
+
+
+class MetaStore:
+    """Metadata of a user's whole store: the base plus delta segments, with disjoint id ranges."""
+
+    def __init__(self, segments=()):
+        self._segments = []
+        for seg in segments:
+            self.add(seg)
+
+    def add(self, seg):
+        if seg is not None and len(seg):
+            lo, hi = seg.bounds()
+            self._segments.append((lo, hi, seg))
+
+    def get(self, eid: int):
+        eid = int(eid)
+        for lo, hi, seg in self._segments:
+            if lo <= eid <= hi:
+                return seg.get(eid)
+        return None
+
+    def rows(self):
+        for _, _, seg in self._segments:
+            yield from seg.rows()
+
+    def needs_migration(self) -> bool:
+        return any(isinstance(seg, JsonSegmentMeta) for _, _, seg in self._segments)
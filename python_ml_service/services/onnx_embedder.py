@@ -0,0 +1,96 @@
+"""
+ONNX Runtime backend for the sentence-transformers embedder (EMBEDDING_BACKEND=onnx).
+
+On first use the Hugging Face model is exported to ONNX with PyTorch,
+quantized to int8 (dynamic quantization of the weights) and written to
+EMBEDDING_ONNX_DIR/<model>/ together with its tokenizer; later starts only
+load those files. Encoding reproduces the sentence-transformers pipeline of
+all-MiniLM-L6-v2: tokenize, transformer, mean pooling over the attention
+mask. Normalization is left to embed_texts, as for the PyTorch backend.
+
+Requires onnxruntime (and onnx, torch and transformers for the export).
+benchmarks/bench_embedding_backends.py checks cosine agreement with the
+PyTorch embeddings and compares throughput.
+"""
+import os
+import importlib
+import numpy as np
+
+ONNX_DIR = os.environ.get('EMBEDDING_ONNX_DIR', os.path.join(os.getcwd(), 'onnx_models'))
+ONNX_THREADS = int(os.environ.get('EMBEDDING_ONNX_THREADS', 0))  # 0: onnxruntime default
+MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2's max_seq_length
+OPSET = 14
+
+
+def _import(name: str, purpose: str):
+    try:
+        return importlib.import_module(name)
+    except Exception as e:
+        raise ImportError(f'{name} is required for {purpose}. Install it into the service venv: pip install {name}') from e
+
+
+def model_dir(model_name: str) -> str:
+    return os.path.join(ONNX_DIR, model_name.replace('/', '_'))
+
+
+def export_onnx(model_name: str, out_dir: str):
+    """Export the Hugging Face model behind model_name to out_dir/model.onnx, plus an int8 copy and the tokenizer."""
+    torch = _import('torch', 'the ONNX export')
+    transformers = _import('transformers', 'the ONNX export')
+    quantization = _import('onnxruntime.quantization', 'the ONNX export')
+
+    hf_name = model_name if '/' in model_name else f'sentence-transformers/{model_name}'
+    tokenizer = transformers.AutoTokenizer.from_pretrained(hf_name)
+    model = transformers.AutoModel.from_pretrained(hf_name)
+    model.eval()
+
+    os.makedirs(out_dir, exist_ok=True)
+    fp32_path = os.path.join(out_dir, 'model.onnx')
+    dummy = tokenizer(['an example sentence'], return_tensors='pt')
+    # Positional order of BertModel.forward
+    input_names = [n for n in ('input_ids', 'attention_mask', 'token_type_ids') if n in dummy]
+    dynamic_axes = { n: {0: 'batch', 1: 'sequence'} for n in input_names + ['last_hidden_state'] }
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(dummy[n] for n in input_names), fp32_path,
+            input_names=input_names, output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes, opset_version=OPSET, do_constant_folding=True,
+        )
+    # Write to a temp name and rename, so a crashed export isn't mistaken for a finished one
+    tmp_path = os.path.join(out_dir, 'model.int8.onnx.tmp')
+    quantization.quantize_dynamic(fp32_path, tmp_path, weight_type=quantization.QuantType.QInt8)
+    tokenizer.save_pretrained(out_dir)
+    os.replace(tmp_path, os.path.join(out_dir, 'model.int8.onnx'))
+    print(f"Exported {hf_name} to {out_dir}")
+
+
+class OnnxEmbedder:
+    """Drop-in for SentenceTransformer.encode, backed by an int8 ONNX Runtime session."""
+
+    def __init__(self, model_name: str, quantized: bool = True):
+        ort = _import('onnxruntime', 'the ONNX embedding backend')
+        transformers = _import('transformers', 'the ONNX embedding backend')
+        d = model_dir(model_name)
+        if not os.path.exists(os.path.join(d, 'model.int8.onnx')):
+            export_onnx(model_name, d)
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(d)
+        options = ort.SessionOptions()
+        if ONNX_THREADS:
+            options.intra_op_num_threads = ONNX_THREADS
+        path = os.path.join(d, 'model.int8.onnx' if quantized else 'model.onnx')
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(self, texts, batch_size: int = 32, **kwargs):
+        """(len(texts), dim) float32 mean-pooled embeddings; extra sentence-transformers kwargs are ignored."""
+        out = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            enc = self.tokenizer(batch, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors='np')
+            feeds = { name: enc[name].astype('int64') for name in self.input_names }
+            hidden = self.session.run(None, feeds)[0]
+            mask = enc['attention_mask'][..., None].astype('float32')
+            out.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        if not out:
+            return np.empty((0, 0), dtype='float32')
+        return np.vstack(out).astype('float32')
@@ -0,0 +1,121 @@
+"""
+Bulk re-embedding of a user's corpus from the MongoDB chunks collection.
+
+Chunks are streamed from a cursor sorted by docId and embedded in groups
+of whole documents (REINDEX_BATCH_TEXTS texts at a time), which
+embed_texts sends to the process pool when EMBED_POOL_WORKERS is set;
+only the current group is in memory. Each document's vectors are then
+replaced via delete + append, going through the same duplicate
+detection and linking as ingest (services/dedup.py), and documents that
+are indexed but no longer in MongoDB are deleted first. Background
+compaction folds the result into a new base.
+"""
+import os
+import time
+from itertools import groupby
+from pymongo import UpdateOne
+
+from services.dedup import DEDUP_ENABLED, find_indexed_duplicates, link_duplicates, record, resolve_repeats, split_repeats
+from services.embeddings import embed_texts
+from services.faiss_index import add_chunks_to_index, delete_document_vectors, indexed_doc_ids
+from services.mongo import chunks_collection
+
+REINDEX_BATCH_TEXTS = int(os.environ.get('REINDEX_BATCH_TEXTS', 4096))
+
+
+def _iter_user_documents(userId: str):
+    """(docId, its chunks in order) from MongoDB, one document at a time."""
+    cursor = chunks_collection.find(
+        {"userId": userId},
+        {"_id": 0, "chunkId": 1, "docId": 1, "pageNumber": 1, "text": 1, "order": 1},
+        sort=[("docId", 1), ("order", 1)],
+        allow_disk_use=True,
+    )
+    for docId, chunks in groupby(cursor, key=lambda c: c["docId"]):
+        chunks = [c for c in chunks if c.get("text")]
+        if chunks:
+            yield docId, chunks
+
+
+def _replace_documents(userId: str, group, first_id):
+    """Reindex a group of documents; first_id is the first vector id written by this run (or None). Returns (chunks, first_id)."""
+    # Repeats inside a document reuse the vector of its first copy, as at ingest
+    docs = []
+    for docId, chunks in group:
+        chunk_objs = [
+            { 'chunkId': c['chunkId'], 'text': c['text'], 'pageNumber': c.get('pageNumber'), 'order': c.get('order', 0) }
+            for c in chunks
+        ]
+        unique, repeats = split_repeats(chunk_objs, {})
+        docs.append((docId, chunk_objs, unique, repeats))
+
+    texts = [obj["text"] for _, _, unique, _ in docs for obj in unique]
+    embeddings = embed_texts(texts)
+    offset = 0
+    for docId, chunk_objs, unique, repeats in docs:
+        doc_embeddings = embeddings[offset:offset + len(unique)]
+        offset += len(unique)
+        delete_document_vectors(userId, docId)
+
+        # Chunks duplicating another document's are linked to its vector, as at ingest
+        links = [None] * len(unique)
+        if DEDUP_ENABLED and unique:
+            # Only vectors written by this run (ids only grow): older ones may come from another model
+            links = [link if link and first_id is not None and link[1] >= first_id else None
+                     for link in find_indexed_duplicates(userId, docId, doc_embeddings)]
+            links = link_duplicates(userId, docId, unique, links)
+        new = [i for i, link in enumerate(links) if not link]
+        if new:
+            faiss_ids = add_chunks_to_index(userId, docId, [unique[i] for i in new], doc_embeddings[new])
+            for i, fid in zip(new, faiss_ids):
+                unique[i]['faissIndex'] = fid
+            if first_id is None:
+                first_id = min(faiss_ids)
+        resolve_repeats(repeats)
+        if DEDUP_ENABLED:
+            record(len(chunk_objs), len(repeats), len(unique) - len(new), embeddings.shape[1] * 4)
+
+        # Keep the backend's copy of the FAISS ids in step
+        chunks_collection.bulk_write([
+            UpdateOne({"chunkId": obj["chunkId"], "userId": userId}, {"$set": {"faissIndex": str(obj["faissIndex"])}})
+            for obj in chunk_objs
+        ], ordered=False)
+    return sum(len(chunk_objs) for _, chunk_objs, _, _ in docs), first_id
+
+
+def reindex_user(userId: str) -> dict:
+    """Re-embed every chunk of a user from MongoDB and rebuild their vectors."""
+    started = time.perf_counter()
+
+    # Only the docIds are held for the whole run, not the chunks
+    documents = { str(docId) for docId in chunks_collection.distinct("docId", {"userId": userId}) }
+    removed = 0
+    for docId in indexed_doc_ids(userId):
+        if docId not in documents:
+            delete_document_vectors(userId, docId)
+            removed += 1
+
+    embedded, reindexed = 0, 0
+    first_id = None
+    group, group_texts = [], 0
+    for docId, chunks in _iter_user_documents(userId):
+        reindexed += 1
+        group.append((docId, chunks))
+        group_texts += len(chunks)
+        if group_texts >= REINDEX_BATCH_TEXTS:
+            chunks_done, first_id = _replace_documents(userId, group, first_id)
+            embedded += chunks_done
+            group, group_texts = [], 0
+    if group:
+        chunks_done, first_id = _replace_documents(userId, group, first_id)
+        embedded += chunks_done
+
+    elapsed = time.perf_counter() - started
+    print(f"✓ REINDEX: userId={userId}: {reindexed} documents, {embedded} chunks in {elapsed:.1f}s"
+          f" ({removed} orphaned documents removed)")
+    return {
+        'documents': reindexed,
+        'chunks': embedded,
+        'removed_documents': removed,
+        'seconds': round(elapsed, 2),
+    }
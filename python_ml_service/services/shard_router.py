@@ -0,0 +1,116 @@
+"""
+Assignment of users to index shards, and routing to the node that owns a shard.
+
+Users are placed on FAISS_NUM_SHARDS shards by consistent hashing (every
+shard has SHARD_VNODES points on a hash ring), so changing the number of
+shards moves only about 1/N of the users. With more than one shard a user's
+store lives under indexes/shard-<k>/<userId>/.
+
+A node serves the shards listed in FAISS_OWNED_SHARDS (default: all of them)
+and keeps their users resident. Index calls for a user on any other shard
+are forwarded to the node FAISS_SHARD_PEERS maps it to, e.g.
+
+    FAISS_NUM_SHARDS=8
+    FAISS_OWNED_SHARDS=0-3
+    FAISS_SHARD_PEERS=4-7=http://ml-b:8000
+
+Shards that are neither owned nor mapped to a peer are served locally, so a
+single node needs no configuration.
+"""
+import os
+import bisect
+import hashlib
+import threading
+import requests
+
+from services.executors import Overloaded
+
+NUM_SHARDS = max(1, int(os.environ.get('FAISS_NUM_SHARDS', 1)))
+SHARD_VNODES = 256
+FORWARD_TIMEOUT = float(os.environ.get('FAISS_SHARD_TIMEOUT', 30))
+
+
+def _parse_shards(spec: str) -> set:
+    """'0-3,6' -> {0, 1, 2, 3, 6}"""
+    shards = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-', 1)
+            shards.update(range(int(lo), int(hi) + 1))
+        else:
+            shards.add(int(part))
+    return shards
+
+
+def _parse_peers(spec: str) -> dict:
+    """'0-3=http://a:8000,4-7=http://b:8000' -> {shard: base url}; each key is one shard or one range"""
+    peers = {}
+    for part in spec.split(','):
+        if '=' not in part:
+            continue
+        shards, url = part.split('=', 1)
+        for shard in _parse_shards(shards):
+            peers[shard] = url.strip().rstrip('/')
+    return peers
+
+
+OWNED_SHARDS = _parse_shards(os.environ.get('FAISS_OWNED_SHARDS', '')) or set(range(NUM_SHARDS))
+PEERS = _parse_peers(os.environ.get('FAISS_SHARD_PEERS', ''))
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode('utf8')).hexdigest()[:16], 16)
+
+
+_ring = sorted((_hash(f'shard-{k}#{v}'), k) for k in range(NUM_SHARDS) for v in range(SHARD_VNODES))
+_ring_points = [point for point, _ in _ring]
+
+# Calls served here vs forwarded, per shard
+_stats_lock = threading.Lock()
+_served = {}
+_forwarded = {}
+
+
+def shard_for(userId: str) -> int:
+    if NUM_SHARDS == 1:
+        return 0
+    i = bisect.bisect(_ring_points, _hash(userId)) % len(_ring)
+    return _ring[i][1]
+
+
+def owns(shard: int) -> bool:
+    return shard in OWNED_SHARDS
+
+
+def peer_for(userId: str):
+    """Base URL of the node that owns userId's shard, or None to serve the call here."""
+    shard = shard_for(userId)
+    peer = None if owns(shard) else PEERS.get(shard)
+    with _stats_lock:
+        counts = _forwarded if peer else _served
+        counts[shard] = counts.get(shard, 0) + 1
+    return peer
+
+
+def forward(peer: str, op: str, payload: dict):
+    """Run an index operation on the peer (see /internal/index/{op}) and return its result."""
+    r = requests.post(f"{peer}/internal/index/{op}", json=payload, timeout=FORWARD_TIMEOUT)
+    if r.status_code == 429:
+        # Pass the peer's backpressure on to our caller
+        raise Overloaded('peer', int(r.headers.get('Retry-After', 1)))
+    r.raise_for_status()
+    return r.json()['result']
+
+
+def shard_stats() -> dict:
+    with _stats_lock:
+        return {
+            'num_shards': NUM_SHARDS,
+            'owned_shards': sorted(OWNED_SHARDS),
+            'peers': { str(shard): url for shard, url in sorted(PEERS.items()) },
+            'served': { str(shard): n for shard, n in sorted(_served.items()) },
+            'forwarded': { str(shard): n for shard, n in sorted(_forwarded.items()) },
+        }
@@ -1,11 +1,12 @@
 import os
-from services.embeddings import embed_texts
+from services.embeddings import embed_texts_async
 from services.faiss_index import search_user_index
 import openai
 from services.mongo import chunks_collection
 import re
 from datetime import datetime
 import json
+from services.executors import run
 
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
@@ -43,10 +44,10 @@ async def query_structured_rag(
     """
     
     # 1️⃣ Embed query
-    query_embedding = embed_texts([query])
+    query_embedding = await embed_texts_async([query])
     
     # 2️⃣ FAISS search
-    results = search_user_index(userId, query_embedding, top_k=10)
+    results = await run('cpu', search_user_index, userId, query_embedding, top_k=10)
     
     print(f"\nStructured Query: {query}")
     print(f"Total retrieved chunks: {len(results)}")
@@ -71,7 +72,7 @@ async def query_structured_rag(
     structured_data = []
     
     if chunk_ids:
-        chunk_docs = list(
+        chunk_docs = await run('network', lambda: list(
             chunks_collection.find(
                 {
                     "chunkId": {"$in": chunk_ids},
@@ -79,7 +80,7 @@ async def query_structured_rag(
                 },
                 {"_id": 0, "chunkId": 1, "docId": 1, "docName": 1, "pageNumber": 1, "text": 1}
             )
-        )
+        ))
         
         for doc in chunk_docs:
             text = doc.get("text", "")
@@ -101,7 +102,7 @@ async def query_structured_rag(
                 Return only the title, no quotes.
                 """
                 
-                response = openai.chat.completions.create(
+                response = await run('network', openai.chat.completions.create,
                     model="gpt-3.5-turbo",
                     messages=[{"role": "user", "content": title_prompt}],
                     temperature=0.3,
@@ -149,7 +150,7 @@ async def query_structured_rag(
             Summary:
             """
             
-            response = openai.chat.completions.create(
+            response = await run('network', openai.chat.completions.create,
                 model="gpt-3.5-turbo",
                 messages=[{"role": "user", "content": summary_prompt}],
                 temperature=0.3,
@@ -2,10 +2,13 @@ from transformers import pipeline
 import logging
 import json
 import os
+import threading
 
 logging.basicConfig(level=logging.WARNING)
 
 _emotion_pipeline = None
+# Feedback runs on executor threads; the patterns file is read-modify-write
+_patterns_lock = threading.Lock()
 
 # Confidence threshold: if top emotion score < this, return neutral
 # Adjusted to 0.35 for better emotion capture (j-hartmann model scores)
@@ -89,6 +92,10 @@ def save_emotion_patterns(patterns):
 
 def learn_emotion_pattern(text: str, emotion: str):
     """Learn from user feedback to improve future detection."""
+    with _patterns_lock:
+        _learn_emotion_pattern(text, emotion)
+
+def _learn_emotion_pattern(text: str, emotion: str):
     patterns = load_emotion_patterns()
     
     # Extract meaningful phrases only (avoid single words)
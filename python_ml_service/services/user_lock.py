@@ -0,0 +1,89 @@
+"""
+Per-user reader/writer locks that hold both within this process and across
+worker processes sharing the same indexes/ directory.
+
+Threads queue on an in-process RWLock first; the holder then takes a
+shared (read) or exclusive (write) flock on the user's lock file, so
+uvicorn workers exclude each other the same way. Where fcntl is not
+available (Windows) only the in-process lock applies.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class RWLock:
+    """Any number of readers or one writer. Waiting writers hold off new readers so they can't starve."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class UserLock:
+    """RWLock plus an flock on lock_path. Not reentrant."""
+
+    def __init__(self, lock_path: str):
+        self.lock_path = lock_path
+        self._rw = RWLock()
+
+    @contextmanager
+    def read(self):
+        with self._rw.read(), self._flock(shared=True):
+            yield
+
+    @contextmanager
+    def write(self):
+        with self._rw.write(), self._flock(shared=False):
+            yield
+
+    @contextmanager
+    def _flock(self, shared: bool):
+        if fcntl is None:
+            yield
+            return
+        # One descriptor per holder: flock locks belong to the open file, so
+        # concurrent readers in this process each hold their own shared lock
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
@@ -6,6 +6,8 @@ import torch
 import whisper
 from transformers import pipeline
 
+from services.executors import run
+
 _whisper_model = None
 _emotion_pipeline = None
 
@@ -23,6 +25,10 @@ def get_emotion_pipeline():
     return _emotion_pipeline
 
 async def transcribe_and_emotion(audio_bytes: bytes):
+    # ffmpeg + Whisper take seconds; keep them on the audio pool, off the event loop
+    return await run('audio', _transcribe_and_emotion, audio_bytes)
+
+def _transcribe_and_emotion(audio_bytes: bytes):
     import os
     # Write incoming bytes to a temp .webm file
     with tempfile.NamedTemporaryFile(suffix='.webm', delete=False) as f_in:
@@ -0,0 +1,263 @@
+"""
+Format-dispatch text extraction. Every format yields the same records, one
+page or section at a time:
+
+    { "pageNumber": 1-based position, "text": normalized text, "section": heading or None }
+
+    pdf    one record per page (utils/pdf_pages.py)
+    docx   paragraphs streamed from word/document.xml; a new section starts
+           at each heading or explicit page break
+    html   streamed through html.parser; sections start at <h1>-<h3>,
+           script/style are skipped
+    md     sections start at '#' headings
+    txt    sections start at form feeds
+
+Anything else must look like UTF-8 text, or extraction fails with
+ValueError. Non-PDF sections are also cut at SECTION_MAX_CHARS, so a long
+file with no headings never becomes one huge record.
+"""
+import os
+import re
+import io
+import codecs
+import zipfile
+from html.parser import HTMLParser
+from urllib.parse import urlparse, unquote
+from xml.etree.ElementTree import iterparse
+
+from utils.pdf_pages import iter_pdf_pages, iter_pdf_file_pages
+
+SECTION_MAX_CHARS = int(os.environ.get('EXTRACT_SECTION_MAX_CHARS', 20000))
+READ_BLOCK_BYTES = 1 << 16
+# Bytes detect_format looks at
+SNIFF_BYTES = 4096
+
+_EXTENSIONS = {
+    '.pdf': 'pdf',
+    '.docx': 'docx',
+    '.html': 'html', '.htm': 'html',
+    '.md': 'md', '.markdown': 'md',
+    '.txt': 'txt', '.text': 'txt', '.csv': 'txt', '.log': 'txt',
+}
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_MD_HEADING = re.compile(r'^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$')
+_HTML_SECTION_TAGS = { 'h1', 'h2', 'h3' }
+_HTML_BLOCK_TAGS = { 'p', 'div', 'br', 'li', 'tr', 'td', 'th', 'h4', 'h5', 'h6', 'section', 'article', 'blockquote', 'pre' }
+_HTML_SKIP_TAGS = { 'script', 'style', 'noscript', 'template', 'head' }
+
+
+def detect_format(head: bytes, source_url: str = '') -> str:
+    """
+    pdf/docx/html/md/txt from the URL's file extension, else from the first
+    bytes (head, SNIFF_BYTES of them). Text formats must look like text;
+    anything else (.doc, images, archives) raises ValueError.
+    """
+    path = unquote(urlparse(source_url).path) if source_url else ''
+    ext = os.path.splitext(path)[1].lower()
+    fmt = _EXTENSIONS.get(ext)
+    if fmt is None:
+        if head.startswith(b'%PDF'):
+            return 'pdf'
+        if head.startswith(b'PK\x03\x04'):
+            return 'docx'
+        lowered = head[:512].lstrip().lower()
+        fmt = 'html' if lowered.startswith((b'<!doctype html', b'<html')) else 'txt'
+    if fmt in ('md', 'txt') and not _looks_like_text(head):
+        kind = f" ({ext})" if ext else ''
+        raise ValueError(f"Unsupported file format{kind}: not a PDF, DOCX, HTML or UTF-8 text document")
+    return fmt
+
+
+def _looks_like_text(head: bytes) -> bool:
+    """No NUL bytes and valid UTF-8 (a multi-byte character cut off at the end of head is fine)."""
+    if b'\x00' in head:
+        return False
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+class _Sections:
+    """Accumulates text into records, starting a new one at headings and size limits."""
+
+    def __init__(self):
+        self.number = 0
+        self.heading = None
+        self.parts = []
+        self.size = 0
+
+    def add(self, text: str):
+        if text:
+            self.parts.append(text)
+            self.size += len(text)
+
+    def full(self) -> bool:
+        return self.size >= SECTION_MAX_CHARS
+
+    def flush(self, next_heading=None):
+        """The finished record (or None if it has no text); later text goes under next_heading."""
+        text = ' '.join(' '.join(self.parts).split())
+        record = None
+        if text:
+            self.number += 1
+            record = { "pageNumber": self.number, "text": text, "section": self.heading }
+        self.parts, self.size = [], 0
+        self.heading = next_heading
+        return record
+
+
+def iter_docx_sections(fp):
+    with zipfile.ZipFile(fp) as archive:
+        if 'word/document.xml' not in archive.namelist():
+            raise ValueError('Unsupported file format: zip archive is not a .docx document')
+        yield from _iter_docx_body(archive)
+
+
+def _iter_docx_body(archive):
+    with archive.open('word/document.xml') as xml:
+        sections = _Sections()
+        for _, elem in iterparse(xml, events=('end',)):
+            if elem.tag != _W + 'p':
+                continue
+            style = elem.find(f'{_W}pPr/{_W}pStyle')
+            style = style.get(_W + 'val', '') if style is not None else ''
+            # Text on either side of an explicit page break, in order
+            pieces = [[]]
+            for node in elem.iter():
+                if node.tag == _W + 't' and node.text:
+                    pieces[-1].append(node.text)
+                elif node.tag in (_W + 'tab', _W + 'br', _W + 'cr'):
+                    if node.get(_W + 'type') == 'page':
+                        pieces.append([])
+                    else:
+                        pieces[-1].append(' ')
+            pieces = [''.join(piece).strip() for piece in pieces]
+            elem.clear()
+
+            if style.lower().startswith(('heading', 'title')) and pieces[0]:
+                record = sections.flush(next_heading=' '.join(pieces))
+            elif sections.full():
+                record = sections.flush(next_heading=sections.heading)
+            else:
+                record = None
+            if record:
+                yield record
+            sections.add(pieces[0])
+            for piece in pieces[1:]:
+                record = sections.flush(next_heading=sections.heading)
+                if record:
+                    yield record
+                sections.add(piece)
+        record = sections.flush()
+        if record:
+            yield record
+
+
+class _HTMLSectionParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.sections = _Sections()
+        self.ready = []
+        self._skip = 0
+        self._heading = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _HTML_SKIP_TAGS:
+            self._skip += 1
+        elif tag in _HTML_SECTION_TAGS and not self._skip:
+            self._heading = []
+        elif tag in _HTML_BLOCK_TAGS:
+            self.sections.add(' ')
+
+    def handle_endtag(self, tag):
+        if tag in _HTML_SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in _HTML_SECTION_TAGS and self._heading is not None:
+            heading = ' '.join(''.join(self._heading).split())
+            self._heading = None
+            self._emit(self.sections.flush(next_heading=heading or None))
+            self.sections.add(heading)
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._heading is not None:
+            self._heading.append(data)
+            return
+        self.sections.add(data)
+        if self.sections.full():
+            self._emit(self.sections.flush(next_heading=self.sections.heading))
+
+    def _emit(self, record):
+        if record:
+            self.ready.append(record)
+
+
+def iter_html_sections(fp):
+    parser = _HTMLSectionParser()
+    reader = io.TextIOWrapper(fp, encoding='utf-8', errors='replace')
+    while True:
+        block = reader.read(READ_BLOCK_BYTES)
+        if not block:
+            break
+        parser.feed(block)
+        yield from parser.ready
+        parser.ready.clear()
+    parser.close()
+    yield from parser.ready
+    record = parser.sections.flush()
+    if record:
+        yield record
+
+
+def iter_text_sections(fp, markdown: bool = False):
+    sections = _Sections()
+    reader = io.TextIOWrapper(fp, encoding='utf-8', errors='replace')
+    # Bounded reads, so a file with no newlines is still cut into sections
+    for line in iter(lambda: reader.readline(READ_BLOCK_BYTES), ''):
+        for i, part in enumerate(line.split('\f')):
+            heading = _MD_HEADING.match(part) if markdown else None
+            if heading:
+                record = sections.flush(next_heading=heading.group(1) or None)
+                part = heading.group(1)
+            elif i > 0 or sections.full():
+                record = sections.flush(next_heading=sections.heading)
+            else:
+                record = None
+            if record:
+                yield record
+            sections.add(part)
+    record = sections.flush()
+    if record:
+        yield record
+
+
+def _with_section(pages):
+    for page in pages:
+        page["section"] = None
+        yield page
+
+
+def iter_sections(fp, fmt: str):
+    """Records from a seekable binary file object holding a document of format fmt."""
+    if fmt == 'pdf':
+        return _with_section(iter_pdf_pages(fp))
+    if fmt == 'docx':
+        return iter_docx_sections(fp)
+    if fmt == 'html':
+        return iter_html_sections(fp)
+    return iter_text_sections(fp, markdown=(fmt == 'md'))
+
+
+def iter_file_sections(path: str, source_url: str = ''):
+    """Records from the file at path; large PDFs use the parallel page extractor."""
+    with open(path, 'rb') as f:
+        fmt = detect_format(f.read(SNIFF_BYTES), source_url)
+    if fmt == 'pdf':
+        yield from _with_section(iter_pdf_file_pages(path))
+        return
+    with open(path, 'rb') as f:
+        yield from iter_sections(f, fmt)
@@ -0,0 +1,103 @@
+"""
+Page-by-page PDF text extraction, serially or across a process pool.
+
+PDFs of at least PDF_PARALLEL_MIN_PAGES pages are cut into slices of
+PDF_PAGES_PER_TASK pages. Each worker process opens the file itself and
+lays out only its slice (pdfminer's page_numbers). Slices are yielded back
+in page order, with at most two per worker in flight, so memory stays
+bounded the same way as the serial path.
+
+This module only imports pdfminer, so spawned workers start quickly
+without loading torch or the embedding model.
+"""
+import os
+import re
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTTextContainer
+from pdfminer.pdfpage import PDFPage
+
+PDF_EXTRACT_WORKERS = int(os.environ.get('PDF_EXTRACT_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 24))
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', 8))
+
+_WHITESPACE = re.compile(r'\s+')
+_SPACED_CAPS = re.compile(r'([A-Z]\s){3,}')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def normalize_page_text(text: str) -> str:
+    """Collapse whitespace and drop runs of spaced-out capitals (letter-spaced headers)."""
+    return _SPACED_CAPS.sub('', _WHITESPACE.sub(' ', text)).strip()
+
+
+def clean_page_text(page_layout) -> str:
+    # Collect, then normalize once: re-normalizing the growing string per element is quadratic
+    parts = [element.get_text() for element in page_layout if isinstance(element, LTTextContainer)]
+    return normalize_page_text(''.join(parts))
+
+
+def iter_pdf_pages(fp, page_numbers=None, first_page=1):
+    """Yield {pageNumber, text} one page at a time from a PDF path or seekable file object."""
+    for page_number, page_layout in enumerate(extract_pages(fp, page_numbers=page_numbers), start=first_page):
+        yield {
+            "pageNumber": page_number,
+            "text": clean_page_text(page_layout)
+        }
+
+
+def count_pages(path: str) -> int:
+    with open(path, 'rb') as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
+
+
+def _extract_slice(path: str, start: int, stop: int):
+    # Runs in a worker process; page_numbers is 0-based
+    return list(iter_pdf_pages(path, page_numbers=set(range(start, stop)), first_page=start + 1))
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: the parent may already hold torch threads
+            _executor = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _executor
+
+
+def iter_pdf_pages_parallel(path: str, n_pages: int = None, pages_per_task: int = None):
+    """Like iter_pdf_pages, with page slices laid out across the process pool."""
+    pages_per_task = pages_per_task or PDF_PAGES_PER_TASK
+    executor = _get_executor()
+    if n_pages is None:
+        n_pages = count_pages(path)
+    slices = deque((start, min(start + pages_per_task, n_pages)) for start in range(0, n_pages, pages_per_task))
+    in_flight = deque()
+    try:
+        while slices or in_flight:
+            while slices and len(in_flight) < 2 * PDF_EXTRACT_WORKERS:
+                start, stop = slices.popleft()
+                in_flight.append(executor.submit(_extract_slice, path, start, stop))
+            yield from sorted(in_flight.popleft().result(), key=lambda p: p["pageNumber"])
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def iter_pdf_file_pages(path: str):
+    """Pages of the PDF at path, extracted in parallel when it's large enough to pay off."""
+    if PDF_EXTRACT_WORKERS > 1:
+        n_pages = count_pages(path)
+        if n_pages >= PDF_PARALLEL_MIN_PAGES:
+            yield from iter_pdf_pages_parallel(path, n_pages)
+            return
+    with open(path, 'rb') as f:
+        yield from iter_pdf_pages(f)
@@ -1,95 +1,109 @@
 import io
+import os
 import re
 from typing import List
-from pdfminer.high_level import extract_pages 
-from pdfminer.layout import LTTextContainer
-import docx
 import nltk
+import numpy as np
 
 
-import re
-from services.embeddings import embed_texts
+from services.embeddings import MAX_SEQ_LENGTH, embed_texts, get_tokenizer
+from utils.extractors import SNIFF_BYTES, detect_format, iter_sections
 
 try:
     nltk.data.find('tokenizers/punkt')
 except Exception:
     nltk.download('punkt')
 
-def extract_text_from_file(content: bytes, source_url: str = ''):
-
-    if source_url.lower().endswith('.pdf') or b'%PDF' in content[:4]:
-        pages = []
-
-        for page_number, page_layout in enumerate(
-            extract_pages(io.BytesIO(content)),
-            start=1
-        ):
-            page_text = ""
-
-            for element in page_layout:
-                if isinstance(element, LTTextContainer):
-                    page_text += element.get_text()
-                    page_text = re.sub(r'\s+', ' ', page_text)
-                    page_text = re.sub(r'([A-Z]\s){3,}', '', page_text)
-
-            pages.append({
-                "pageNumber": page_number,
-                "text": page_text.strip()
-            })
-
-        return pages
-
-    # fallback: decode
-    try:
-        text = content.decode('utf-8')
-    except Exception:
-        text = ''
-    return text
-
-def chunk_text(text: str, min_tokens=500, max_tokens=700) -> List[dict]:
-    # approximate tokens by words
-    words = re.split(r'\s+', text.strip())
-    if not words:
-        return []
-
-    avg_token_per_word = 0.75
-    target_words = int((min_tokens + max_tokens) / 2 * (1/avg_token_per_word))
-
-    chunks = []
-    i = 0
-    idx = 0
-    while i < len(words):
-        part = words[i:i+target_words]
-        chunk_text = ' '.join(part).strip()
-        if chunk_text:
-            chunks.append({ 'chunkId': None, 'text': chunk_text, 'order': idx })
-            idx += 1
-        i += target_words
-    return chunks
-
-
-
-def extract_best_sentence(query, chunk_text):
-    sentences = re.split(r'(?<=[.!?])\s+', chunk_text)
+# Chunk budget in model tokens; the 2 left over are [CLS] and [SEP]
+CHUNK_MAX_TOKENS = int(os.environ.get('CHUNK_MAX_TOKENS', MAX_SEQ_LENGTH - 2))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 32))
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+_punkt = True
 
+def extract_text_from_file(content: bytes, source_url: str = ''):
+    """Page/section records ({pageNumber, text, section}) for an in-memory file of any supported format."""
+    return list(iter_sections(io.BytesIO(content), detect_format(content[:SNIFF_BYTES], source_url)))
+
+def split_sentences(text: str) -> List[str]:
+    """Sentences via nltk punkt, or a punctuation split when punkt isn't available."""
+    global _punkt
+    if _punkt:
+        try:
+            return nltk.sent_tokenize(text)
+        except LookupError:
+            _punkt = False
+    return [s for s in _SENTENCE_END.split(text) if s.strip()]
+
+def _token_windows(tokenizer, sentence: str, max_tokens: int):
+    """Cut a sentence longer than max_tokens into max_tokens-token pieces at token boundaries."""
+    offsets = tokenizer(sentence, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+    for start in range(0, len(offsets), max_tokens):
+        window = offsets[start:start + max_tokens]
+        yield sentence[window[0][0]:window[-1][1]], len(window)
+
+def iter_chunks(pages, max_tokens: int = None, overlap_tokens: int = None):
+    """
+    Pack each page's sentences into chunks of at most max_tokens tokens of
+    the embedding model's tokenizer, so nothing is truncated at embedding
+    time. Consecutive chunks of a page share up to overlap_tokens tokens
+    of whole trailing sentences; sentences longer than a chunk are cut at
+    token boundaries. Yields {text, pageNumber, tokens} as pages arrive.
+    """
+    max_tokens = max_tokens or CHUNK_MAX_TOKENS
+    overlap_tokens = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    tokenizer = get_tokenizer()
+
+    for page in pages:
+        sentences = [s.strip() for s in split_sentences(page["text"]) if s.strip()]
+        if not sentences:
+            continue
+        counts = [len(ids) for ids in tokenizer(sentences, add_special_tokens=False)['input_ids']]
+
+        window, size = [], 0
+        for sentence, n in zip(sentences, counts):
+            units = [(sentence, n)] if n <= max_tokens else _token_windows(tokenizer, sentence, max_tokens)
+            for unit in units:
+                if window and size + unit[1] > max_tokens:
+                    yield { "text": ' '.join(u[0] for u in window), "pageNumber": page["pageNumber"], "tokens": size }
+                    # Carry whole trailing sentences over, as long as the next one still fits
+                    kept, kept_size = [], 0
+                    for u in reversed(window):
+                        if kept_size + u[1] > overlap_tokens or kept_size + u[1] + unit[1] > max_tokens:
+                            break
+                        kept.insert(0, u)
+                        kept_size += u[1]
+                    window, size = kept, kept_size
+                window.append(unit)
+                size += unit[1]
+        if window:
+            yield { "text": ' '.join(u[0] for u in window), "pageNumber": page["pageNumber"], "tokens": size }
+
+def chunk_text(text: str, max_tokens: int = None, overlap_tokens: int = None) -> List[dict]:
+    chunks = iter_chunks([{ "pageNumber": 1, "text": text }], max_tokens, overlap_tokens)
+    return [{ 'chunkId': None, 'text': c['text'], 'order': idx } for idx, c in enumerate(chunks)]
+
+
+
+def extract_best_sentences(query_embedding, chunk_texts, per_chunk: int = 1) -> List[List[str]]:
+    """
+    For each chunk, its per_chunk sentences closest to the query, in their
+    original order. The sentences of all chunks are embedded in one call
+    and scored with one matrix-vector product against the (normalized)
+    query embedding, which the caller already has.
+    """
+    splits = [[s.strip() for s in split_sentences(text) if s.strip()] or [text[:300]] for text in chunk_texts]
+    sentences = [s for chunk in splits for s in chunk]
     if not sentences:
-        return chunk_text[:300]
-
-    # Embed query once
-    query_embedding = embed_texts([query])[0]
-
-    # Embed sentences
-    sentence_embeddings = embed_texts(sentences)
+        return [[] for _ in chunk_texts]
+    scores = embed_texts(sentences) @ np.asarray(query_embedding, dtype='float32').reshape(-1)
 
-    best_score = -1
-    best_sentence = sentences[0]
+    best, start = [], 0
+    for chunk in splits:
+        chunk_scores = scores[start:start + len(chunk)]
+        start += len(chunk)
+        keep = np.sort(np.argsort(-chunk_scores, kind='stable')[:per_chunk])
+        best.append([chunk[i] for i in keep])
+    return best
 
-    for sentence, emb in zip(sentences, sentence_embeddings):
-        # cosine similarity
-        score = sum(a*b for a,b in zip(query_embedding, emb))
-
-        if score > best_score:
-            best_score = score
-            best_sentence = sentence
-
-    return best_sentence.strip()
\ No newline at end of file
+def extract_best_sentence(query, chunk_text):
+    return extract_best_sentences(embed_texts([query])[0], [chunk_text])[0][0]